@@ -924,7 +924,7 @@ schema = [
 
 if __name__ == '__main__':
     import functools
-    from http.server import HTTPServer
+    from http.server import ThreadingHTTPServer
     import threading
     import os
     import signal
@@ -956,6 +956,9 @@ if __name__ == '__main__':
     lag = 20
     silent = False
     metrics_endpoint = None
+    keepalive = None
+    max_bytes = None
+    refresh = 0
     disk_limit = None
     skip = True
     pidfile = None
@@ -966,7 +969,8 @@ if __name__ == '__main__':
     schedule = set()
     opts, args = gnu_getopt(sys.argv[1:], "zh:l:T:t:s:M:",
                             [ 'disk-limit=', 'log=', 'log-file=', 'now',
-                              'pid-file=' ])
+                              'pid-file=', 'keepalive=', 'max-bytes=',
+                              'refresh-interval=' ])
     for opt, val in opts:
         if opt == '-h':
             horizon = int(val)
@@ -987,6 +991,12 @@ if __name__ == '__main__':
             http_host = val
         elif opt == '-M':
             metrics_endpoint = val
+        elif opt == '--keepalive':
+            keepalive = int(val)
+        elif opt == '--max-bytes':
+            max_bytes = int(val)
+        elif opt == '--refresh-interval':
+            refresh = int(val)
         elif opt == '-t':
             http_port = int(val)
         elif opt == '--log':
@@ -1059,24 +1069,27 @@ if __name__ == '__main__':
     ## Define a remote-write endpoint, and an object to pull disc
     ## metrics on command, and remote-write them immediately to that
     ## endpoint.
+    compiled_schema = metrics.compile_schema(schema)
     rmw = metrics.RemoteMetricsWriter(endpoint=metrics_endpoint,
-                                      schema=schema,
+                                      schema=compiled_schema,
                                       job='cephhealth',
-                                      expiry=horizon)
+                                      expiry=horizon,
+                                      keepalive=keepalive)
     pusher = CephHealthMetricPusher(rmw, cmdpfx=args, limit=disk_limit)
 
     ## Define how to get on-demand metrics.  Use a separate thread to
     ## run the server, which we can stop by calling
     ## webserver.shutdown().
     # cephcoll = CephHealthCollector(args, lag=lag, horizon=horizon)
-    methist = metrics.MetricHistory(schema, horizon=horizon)
+    methist = metrics.MetricHistory(compiled_schema, horizon=horizon,
+                                    max_bytes=max_bytes)
     updater = functools.partial(update_live_metrics, methist, args=args)
     #nowmets = functools.partial(get_osd_complaints_as_metrics, args=args)
-    partial_handler = functools.partial(metrics.MetricsHTTPHandler,
-                                        hist=methist,
-                                        prescrape=updater)
+    partial_handler = methist.http_handler(prescrape=updater,
+                                           interval=refresh)
     try:
-        webserver = HTTPServer((http_host, http_port), partial_handler)
+        webserver = ThreadingHTTPServer((http_host, http_port),
+                                        partial_handler)
     except OSError as e:
         if e.errno == errno.EADDRINUSE:
             sys.stderr.write('Stopping: address in use: %s:%d\n' % \
@@ -1094,7 +1107,7 @@ if __name__ == '__main__':
                 pass
             pass
 
-        srv_thrd = threading.Thread(target=HTTPServer.serve_forever,
+        srv_thrd = threading.Thread(target=ThreadingHTTPServer.serve_forever,
                                     args=(webserver,),
                                     daemon=True)
         srv_thrd.start()
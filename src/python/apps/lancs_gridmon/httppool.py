@@ -0,0 +1,221 @@
+## Copyright (c) 2026, Lancaster University
+## All rights reserved.
+##
+## Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions
+## are met:
+##
+## 1. Redistributions of source code must retain the above copyright
+##    notice, this list of conditions and the following disclaimer.
+##
+## 2. Redistributions in binary form must reproduce the above
+##    copyright notice, this list of conditions and the following
+##    disclaimer in the documentation and/or other materials provided
+##    with the distribution.
+##
+## 3. Neither the name of the copyright holder nor the names of its
+##    contributors may be used to endorse or promote products derived
+##    from this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+## "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+## LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+## FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+## COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+## INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+## (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+## SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+## HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+## STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+## ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+## OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import threading
+import time
+import select
+import ssl
+import functools
+import http.client
+from urllib.parse import urlsplit
+
+def _healthy(conn):
+    ## An idle connection should have nothing to read.  If it has,
+    ## the server has most likely closed it.
+    sock = conn.sock
+    if sock is None:
+        return False
+    tls = isinstance(sock, ssl.SSLSocket)
+    if tls and sock.pending() > 0:
+        ## Decrypted data is already buffered, so select won't see it.
+        return False
+    try:
+        readable, _, _ = select.select([ sock ], [ ], [ ], 0)
+    except (OSError, ValueError):
+        return False
+    if len(readable) == 0:
+        return True
+    if not tls:
+        return False
+
+    ## A TLS 1.3 server may send session tickets after the
+    ## handshake, so the socket can be readable without any response
+    ## data.  Let the TLS layer consume such records; only data or
+    ## end-of-file means the connection is unusable.
+    timeout = sock.gettimeout()
+    try:
+        sock.setblocking(False)
+        sock.recv(1)
+    except ssl.SSLWantReadError:
+        return True
+    except (OSError, ValueError):
+        return False
+    finally:
+        try:
+            sock.settimeout(timeout)
+        except OSError:
+            pass
+        pass
+    return False
+
+class HTTPConnectionPool:
+    """Keep-alive connections to a single HTTP or HTTPS origin, with a
+    limit on how many may be in use at once.  Idle connections are
+    reused most recent first, and discarded if they have been idle
+    too long or appear to have been closed by the server.
+
+    """
+    def __init__(self, scheme, host, port=None, limit=2, idle_timeout=60,
+                 timeout=60, context=None):
+        if scheme == 'https':
+            self._factory = \
+                functools.partial(http.client.HTTPSConnection, host, port,
+                                  timeout=timeout, context=context)
+        elif scheme == 'http':
+            self._factory = \
+                functools.partial(http.client.HTTPConnection, host, port,
+                                  timeout=timeout)
+        else:
+            raise ValueError('unsupported scheme %s' % scheme)
+        self._slots = threading.BoundedSemaphore(limit)
+        self._lock = threading.Lock()
+        self._idle = list()
+        self._idle_timeout = idle_timeout
+        self._counters = {
+            'opened': 0,
+            'reused': 0,
+            'discarded': 0,
+        }
+        pass
+
+    def stats(self):
+        with self._lock:
+            res = dict(self._counters)
+            res['idle'] = len(self._idle)
+            return res
+        pass
+
+    def __open(self):
+        with self._lock:
+            self._counters['opened'] += 1
+            pass
+        return self._factory()
+
+    def __get(self):
+        ## Get the most recently used connection that still looks
+        ## usable, or make a new one.  Also indicate whether it is
+        ## being reused.
+        now = time.monotonic()
+        with self._lock:
+            while len(self._idle) > 0:
+                conn, since = self._idle.pop()
+                if now - since < self._idle_timeout and _healthy(conn):
+                    self._counters['reused'] += 1
+                    return conn, True
+                conn.close()
+                self._counters['discarded'] += 1
+                continue
+            pass
+        return self.__open(), False
+
+    def __put(self, conn):
+        with self._lock:
+            self._idle.append((conn, time.monotonic()))
+            pass
+        pass
+
+    @staticmethod
+    def __exchange(conn, method, path, body, headers):
+        conn.request(method, path, body=body, headers=headers)
+        rsp = conn.getresponse()
+        data = rsp.read()
+        return rsp.status, rsp.reason, data, rsp.will_close
+
+    def request(self, method, path, body=None, headers=None):
+        """Make a request, blocking while too many others are in
+        progress.  The status code, reason and response body are
+        returned.  Connection failures raise OSError or
+        http.client.HTTPException.
+
+        """
+        if headers is None:
+            headers = dict()
+            pass
+        with self._slots:
+            conn, reused = self.__get()
+            try:
+                try:
+                    res = self.__exchange(conn, method, path, body, headers)
+                except (http.client.RemoteDisconnected,
+                        ConnectionResetError, BrokenPipeError):
+                    ## The server might have closed a reused
+                    ## connection just as we tried to use it, so try
+                    ## once more with a new one.
+                    if not reused:
+                        raise
+                    conn.close()
+                    conn = self.__open()
+                    res = self.__exchange(conn, method, path, body, headers)
+                    pass
+            except:
+                conn.close()
+                raise
+            status, reason, data, will_close = res
+            if will_close:
+                conn.close()
+            else:
+                self.__put(conn)
+                pass
+            return status, reason, data
+        pass
+
+    pass
+
+_pools = dict()
+_pools_lock = threading.Lock()
+
+def get_pool(url, **kwargs):
+    """Get the connection pool shared by all users of the origin of a
+    URL.  Keyword arguments are passed to HTTPConnectionPool if the
+    pool has to be created, and are otherwise ignored.
+
+    """
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.hostname, parts.port)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = HTTPConnectionPool(*key, **kwargs)
+            _pools[key] = pool
+            pass
+        return pool
+    pass
+
+def request_target(url):
+    """Get the path and query of a URL, as used in a request line."""
+    parts = urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+        pass
+    return path
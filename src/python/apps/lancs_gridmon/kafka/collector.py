@@ -41,7 +41,7 @@ import functools
 import hashlib
 import pathlib
 from datetime import datetime
-from http.server import HTTPServer
+from http.server import ThreadingHTTPServer
 import threading
 import os
 import signal
@@ -55,6 +55,8 @@ import lancs_gridmon.metrics as metrics
 from lancs_gridmon.trees import merge_trees
 
 horizon = 30 * 60
+max_bytes = None
+refresh = 0
 silent = False
 pidfile = None
 log_params = {
@@ -68,10 +70,15 @@ http_port = 8567
 config = { }
 
 opts, args = gnu_getopt(sys.argv[1:], 'h:f:T:t:z',
-                        [ 'log=', 'log-file=', 'pid-file='])
+                        [ 'log=', 'log-file=', 'pid-file=', 'max-bytes=',
+                          'refresh-interval=' ])
 for opt, val in opts:
     if opt == '-h':
         horizon = int(val)
+    elif opt == '--max-bytes':
+        max_bytes = int(val)
+    elif opt == '--refresh-interval':
+        refresh = int(val)
     elif opt == '-z':
         silent = True
     elif opt == '-f':
@@ -259,13 +266,12 @@ schema = [
     },
 ]
 
-methist = metrics.MetricHistory(schema, horizon=horizon)
+methist = metrics.MetricHistory(schema, horizon=horizon, max_bytes=max_bytes)
 updater = functools.partial(update_live_metrics, methist, stats, stats_lock)
-partial_handler = functools.partial(metrics.MetricsHTTPHandler,
-                                    hist=methist,
-                                    prescrape=updater)
+partial_handler = methist.http_handler(prescrape=updater, interval=refresh)
 try:
-    webserver = HTTPServer((http_host, http_port), partial_handler)
+    webserver = ThreadingHTTPServer((http_host, http_port),
+                                    partial_handler)
 except OSError as e:
     if e.errno == errno.EADDRINUSE:
         sys.stderr.write('Stopping: address in use: %s:%d\n' % \
@@ -35,10 +35,17 @@ import time
 import traceback
 import logging
 import functools
+import bisect
+import collections
+import operator
+import math
+import contextlib
+from array import array
 
 from http.server import BaseHTTPRequestHandler
 
-from lancs_gridmon.trees import merge_trees
+from lancs_gridmon.trees import merged_trees
+from lancs_gridmon.trees import tree_size, merged_size
 
 def _safe_mod(spec, idx, snapshot):
     vals = list()
@@ -79,6 +86,1388 @@ def _get_sample_func(xxx):
         return ('%s', _safe_func(xxx))
     pass
 
+def _compile_label(name, vspec):
+    """Convert an 'attrs' entry into a function taking a series index
+    and a snapshot, and yielding a list of (name, value) pairs.  The
+    format and value functions are resolved once, so the returned
+    function does no further interpretation of the schema.
+
+    """
+    if callable(vspec):
+        ## vspec is to be called with the entry details, and yields
+        ## multiple key-value pairs, whose keys are suffixes to the
+        ## label name.  A plain value is used as the label value.
+        def multi(tup, entry):
+            res = vspec(tup, entry)
+            if not isinstance(res, dict):
+                return [] if res is None else [ (name, '%s' % (res,)) ]
+            return [ (name + sfx, lval) for sfx, lval in res.items()
+                     if lval is not None ]
+        return multi
+
+    ## The first element of vspec is a format string, containing
+    ## len(vspec)-1 format specifiers.  The remaining elements are
+    ## functions to be supplied with details of the entry being
+    ## rendered.  The functions' values are used to fulfil the format
+    ## specifiers.
+    vspec = _get_sample_func(vspec)
+    fmt = vspec[0]
+    funcs = vspec[1:]
+    if len(funcs) == 1:
+        func = funcs[0]
+        def single(tup, entry):
+            val = func(tup, entry)
+            if val is None:
+                return []
+            return [ (name, fmt % (val,)) ]
+        return single
+
+    def several(tup, entry):
+        lval = _safe_mod(vspec, tup, entry)
+        if lval is None:
+            return []
+        return [ (name, lval) ]
+    return several
+
+class _NativeValue:
+    """The state of a native histogram at one time.  Bucket counts are
+    held in dicts from bucket index to (non-cumulative) count, for
+    positive and negative observations.  Histograms with the same
+    schema and zero threshold can be added, e.g., when folded.
+
+    """
+
+    def __init__(self, schema, zero_threshold):
+        self.schema = schema
+        self.zero_threshold = zero_threshold
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.positive = { }
+        self.negative = { }
+        pass
+
+    def __eq__(self, other):
+        return isinstance(other, _NativeValue) and \
+            self.schema == other.schema and \
+            self.zero_threshold == other.zero_threshold and \
+            self.zero_count == other.zero_count and \
+            self.count == other.count and self.sum == other.sum and \
+            self.positive == other.positive and \
+            self.negative == other.negative
+
+    def __add__(self, other):
+        res = _NativeValue(self.schema, self.zero_threshold)
+        res.zero_count = self.zero_count + other.zero_count
+        res.count = self.count + other.count
+        res.sum = self.sum + other.sum
+        for dst, srcs in ((res.positive, (self.positive, other.positive)),
+                          (res.negative, (self.negative, other.negative))):
+            for src in srcs:
+                for idx, cnt in src.items():
+                    dst[idx] = dst.get(idx, 0) + cnt
+                    continue
+                continue
+            continue
+        return res
+
+    def observe(self, value, count):
+        """Add observations of a value."""
+        self.count += count
+        self.sum += value * count
+        mag = abs(value)
+        if mag <= self.zero_threshold:
+            self.zero_count += count
+            return
+        ## Bucket i holds (b**(i-1), b**i], where b is
+        ## 2**(2**-schema).  Exact powers of two are computed exactly.
+        frac, exp = math.frexp(mag)
+        if frac == 0.5:
+            idx = math.ceil((exp - 1) * 2.0 ** self.schema)
+        else:
+            idx = math.ceil(math.log2(mag) * 2.0 ** self.schema)
+            pass
+        buckets = self.positive if value > 0 else self.negative
+        buckets[idx] = buckets.get(idx, 0) + count
+        pass
+
+    def bound(self, idx):
+        """Get the upper bound of a positive bucket."""
+        return 2.0 ** (idx * 2.0 ** -self.schema)
+
+    def spans(self, buckets):
+        """Encode buckets as a list of (offset, length) spans, and a list
+        of deltas between consecutive counts.
+
+        """
+        spans = [ ]
+        deltas = [ ]
+        last_idx = None
+        last_cnt = 0
+        for idx in sorted(buckets):
+            cnt = buckets[idx]
+            if last_idx is None:
+                spans.append([ idx, 1 ])
+            elif idx == last_idx + 1:
+                spans[-1][1] += 1
+            else:
+                spans.append([ idx - last_idx - 1, 1 ])
+                pass
+            deltas.append(cnt - last_cnt)
+            last_idx = idx
+            last_cnt = cnt
+            continue
+        return spans, deltas
+
+    def classic(self):
+        """Convert into a classic histogram, as a dict from the upper
+        bound of each populated bucket to its cumulative count, plus
+        'sum' and 'count' entries.
+
+        """
+        bounds = [ (-self.bound(idx - 1), cnt)
+                   for idx, cnt in self.negative.items() ]
+        if self.zero_count > 0:
+            bounds.append((self.zero_threshold, self.zero_count))
+            pass
+        bounds.extend((self.bound(idx), cnt)
+                      for idx, cnt in self.positive.items())
+        bounds.sort()
+        res = { }
+        tot = 0
+        for bnd, cnt in bounds:
+            tot += cnt
+            res[bnd] = tot
+            continue
+        res['sum'] = self.sum
+        res['count'] = self.count
+        return res
+
+    pass
+
+class NativeHistogram:
+    """A sample format yielding a native histogram, whose buckets are
+    spaced exponentially, with bounds at powers of 2**(2**-schema).
+    'schema' is from -4 to 8.  The value function should yield the
+    observations, as a dict from value to count, or a sequence of
+    (value, count) pairs.  Observations no further from zero than
+    'zero_threshold' are counted in a separate bucket.
+
+    Remote-write and the protobuf exposition format carry the
+    histogram natively.  As the OpenMetrics text format can't, it is
+    rendered there as a classic histogram, with a bucket for each
+    populated native bucket.
+
+    """
+
+    def __init__(self, schema=3, zero_threshold=2.0 ** -128):
+        if schema < -4 or schema > 8:
+            raise ValueError('native histogram schema %d not in [-4, 8]' %
+                             schema)
+        self.schema = schema
+        self.zero_threshold = zero_threshold
+        pass
+
+    def native(self, obs):
+        """Convert observations into a native histogram."""
+        res = _NativeValue(self.schema, self.zero_threshold)
+        if isinstance(obs, dict):
+            obs = obs.items()
+            pass
+        for value, count in obs:
+            res.observe(value, count)
+            continue
+        return res
+
+    def __call__(self, obs):
+        return self.native(obs).classic()
+
+    pass
+
+class _CompiledFamily:
+    """A metric family whose schema entry has been interpreted once.
+    The names of all samples (including any unit suffix), the metadata
+    header lines, and functions to generate labels and values are
+    prepared in advance, so rendering a family only requires calling
+    the schema's own functions on each snapshot.
+
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.base = spec['base']
+        self.select = spec['select']
+        self.type = spec.get('type')
+        self.unit = spec.get('unit')
+        self.help = spec.get('help')
+
+        typ = self.type
+        self.gcount_name = 'gcount' if typ == 'gaugehistogram' else 'count'
+        self.gsum_name = 'gsum' if typ == 'gaugehistogram' else 'sum'
+
+        ## Histogram sums are rendered as integers, unless the family
+        ## gives another format.
+        self.sum_format = ' ' + spec.get('sum_format', '%d')
+
+        ## The name of a metric with a unit should end with the unit.
+        self.name = self.base
+        if self.unit is not None:
+            self.name += '_' + self.unit
+            pass
+
+        ## Prepare the metadata lines.
+        self.header = ''
+        if typ is not None:
+            self.header += '# TYPE %s %s\n' % (self.name, typ)
+            pass
+        if self.unit is not None:
+            self.header += '# UNIT %s %s\n' % (self.name, self.unit)
+            pass
+        if self.help is not None:
+            ## TODO: Escape the message.
+            self.header += '# HELP %s %s\n' % (self.name, self.help)
+            pass
+
+        ## Each label is generated by a function yielding a list of
+        ## name-value pairs.
+        attrs = spec.get('attrs')
+        if attrs is None:
+            attrs = { }
+            pass
+        self.labellers = [ _compile_label(an, vspec)
+                           for an, vspec in attrs.items() ]
+
+        ## If the series are selected by keys() (a KeySelector), each
+        ## series' node can be obtained along with its index.
+        self.nodes = getattr(self.select, 'nodes', None)
+
+        ## Each sample is described by its full name, its format (a
+        ## string or a histogram converter), its value function, and
+        ## optionally a function applied to the series' node instead,
+        ## if the value function is a walk() relative to the node.
+        self.samples = list()
+        for sfx, xxx in spec['samples'].items():
+            fmt, func = _get_sample_func(xxx)
+            leaf = None
+            if self.nodes is not None and hasattr(func, 'relative'):
+                ## The function is a Walker.
+                leaf = func.relative(self.select)
+                pass
+            self.samples.append((self.name + sfx, fmt, _safe_func(func),
+                                 leaf))
+            continue
+
+        ## Points of single-valued samples are rendered with their own
+        ## formats, and those of histograms as integers, as text()
+        ## renders them.
+        self.formats = { mtr: ' ' + fmt for mtr, fmt, func, leaf
+                         in self.samples if not callable(fmt) }
+        for mtr, fmt, func, leaf in self.samples:
+            if not callable(fmt):
+                continue
+            for sfx in ('bucket', self.gcount_name):
+                self.formats[mtr + '_' + sfx] = ' %d'
+                continue
+            self.formats[mtr + '_' + self.gsum_name] = self.sum_format
+            continue
+
+        ## The layout of the family in the protobuf format is only
+        ## prepared if needed.
+        self.proto = None
+        pass
+
+    def series(self, entry):
+        """Yield each series of a snapshot as an (index, node) pair.
+        The node is the sub-tree reached by the index, or None if the
+        selection function doesn't provide it.
+
+        """
+        if self.nodes is not None:
+            return self.nodes(entry)
+        return ((tup, None) for tup in self.select(entry))
+
+    def labels(self, tup, entry):
+        """Get the labels of a series as a list of name-value pairs."""
+        res = [ ]
+        for lf in self.labellers:
+            res.extend(lf(tup, entry))
+            continue
+        return res
+
+    def text(self, tup, k, entry, node=None):
+        """Render all samples of a series at one timestamp.  The node
+        may be supplied as yielded by series().
+
+        """
+        ## Each label is a name-value pair.  TODO: Escape the value.
+        ## TODO: Sanity-check the name.
+        labels = [ '%s="%s"' % lv for lv in self.labels(tup, entry) ]
+        lstr = '{' + ','.join(labels) + '}'
+        kstr = ' %.3f\n' % k
+
+        msg = ''
+        for mtr, fmt, func, leaf in self.samples:
+            value = func(tup, entry) if leaf is None or node is None \
+                else leaf(node)
+            if not callable(fmt):
+                ## The metric is a single value, not a histogram.
+                msg += mtr + lstr + ' ' + fmt % (value,) + kstr
+                continue
+
+            ## Treat the extracted value as histogram data, and
+            ## convert it into a dict of 'sum' (the sum of the events'
+            ## values), 'count' (the number of events), with the
+            ## remaining keys being int/float thresholds giving the
+            ## cummulative contents of each bucket.  The first entry
+            ## must be 0.
+            value = fmt(value)
+            gsum = value['sum']
+            gcount = value['count']
+
+            ## Extract and sort the thresholds, and generate the
+            ## buckets.
+            thrs = [ thr for thr in value.keys()
+                     if isinstance(thr, (int,float)) ]
+            thrs.sort()
+            pfx = mtr + '_bucket{' + ''.join([ l + ',' for l in labels ])
+            for thr in thrs:
+                msg += pfx + 'le="%g"} %d' % (thr, value[thr]) + kstr
+                continue
+
+            ## The +inf bucket and the count are the same.
+            msg += pfx + 'le="+inf"} %d' % gcount + kstr
+            msg += mtr + '_' + self.gcount_name + lstr + ' %d' % gcount + kstr
+            msg += mtr + '_' + self.gsum_name + lstr + \
+                self.sum_format % gsum + kstr
+            continue
+        return msg
+
+    def fragments(self, k, entry, over=None, fold=()):
+        """Render each series of the family at one timestamp.  A dict
+        is returned, mapping each series index to its OpenMetrics text,
+        in the order yielded by the selection function.
+
+        Series whose indices are in 'over' are left out.  If 'fold'
+        names some labels, they are instead combined by fold(), and
+        each resulting series is keyed by (_FOLDED, labels).
+
+        """
+        if not over:
+            return { tup: self.text(tup, k, entry, node)
+                     for tup, node in self.series(entry) }
+        res = { }
+        excess = [ ]
+        for tup, node in self.series(entry):
+            if tup not in over:
+                res[tup] = self.text(tup, k, entry, node)
+            elif fold:
+                excess.append((tup, node))
+                pass
+            continue
+        for labels, points in self.fold(excess, entry, fold).items():
+            res[(_FOLDED, labels)] = self.point_text(labels, points, k)
+            continue
+        return res
+
+    def classic_points(self, points):
+        """Expand native histograms amongst points, as yielded by
+        points(), into classic ones.
+
+        """
+        for name, extra, value in points:
+            if not isinstance(value, _NativeValue):
+                yield name, extra, value
+                continue
+            value = value.classic()
+            for thr in sorted(thr for thr in value.keys()
+                              if isinstance(thr, (int, float))):
+                yield name + '_bucket', (('le', '%g' % thr),), value[thr]
+                continue
+            yield name + '_bucket', (('le', '+inf'),), value['count']
+            yield name + '_' + self.gcount_name, (), value['count']
+            yield name + '_' + self.gsum_name, (), value['sum']
+            continue
+        pass
+
+    def fold(self, items, entry, names):
+        """Combine series by replacing the values of the named labels
+        with 'other'.  'items' is a sequence of (index, node) pairs,
+        as yielded by series().  Values of series whose remaining
+        labels match are summed, except that the earliest _created
+        value is taken.  A dict is returned, mapping each tuple of
+        label name-value pairs to a list of (name, extra labels,
+        value) tuples, as from points().
+
+        """
+        groups = { }
+        for tup, node in items:
+            labels = tuple((ln, 'other' if ln in names else lv)
+                           for ln, lv in self.labels(tup, entry))
+            sums = groups.setdefault(labels, { })
+            for name, extra, value in self.points(tup, entry, node):
+                if value is None:
+                    continue
+                old = sums.get((name, extra))
+                if old is None:
+                    sums[(name, extra)] = value
+                elif name.endswith('_created'):
+                    sums[(name, extra)] = min(old, value)
+                else:
+                    sums[(name, extra)] = old + value
+                    pass
+                continue
+            continue
+        return { labels: [ key + (value,) for key, value in sums.items() ]
+                 for labels, sums in groups.items() }
+
+    def point_text(self, labels, points, k):
+        """Render points as yielded by points() or fold(), with the
+        given labels, at one timestamp.  Values are rendered with the
+        formats of their samples, as text() renders them, or, if
+        unknown, integers as such, and other values to three decimal
+        places.  Native histograms are rendered as classic ones.
+
+        """
+        kstr = ' %.3f\n' % k
+        msg = ''
+        for name, extra, value in self.classic_points(points):
+            lstr = ','.join([ '%s="%s"' % lv for lv in labels + extra ])
+            fmt = self.formats.get(name)
+            if fmt is None:
+                fmt = ' %d' if isinstance(value, int) else ' %.3f'
+                pass
+            msg += name + '{' + lstr + '}' + fmt % value + kstr
+            continue
+        return msg
+
+    def points(self, tup, entry, node=None):
+        """Get the sample points of a series from a snapshot, as a list of
+        (name, extra labels, value) tuples.  Histograms are expanded
+        into their buckets, count and sum.  The node may be supplied
+        as yielded by series().
+
+        """
+        res = [ ]
+        for mtr, fmt, func, leaf in self.samples:
+            value = func(tup, entry) if leaf is None or node is None \
+                else leaf(node)
+            if not callable(fmt):
+                res.append((mtr, (), value))
+                continue
+            if isinstance(fmt, NativeHistogram):
+                res.append((mtr, (), fmt.native(value)))
+                continue
+
+            ## Convert the value using the function.
+            value = fmt(value)
+            for thr, thrv in value.items():
+                if isinstance(thr, (int, float)):
+                    res.append((mtr + '_bucket', (('le', '%g' % thr),), thrv))
+                    pass
+                continue
+
+            ## The +inf bucket and the count are the same.
+            res.append((mtr + '_bucket', (('le', '+inf'),), value['count']))
+            res.append((mtr + '_' + self.gcount_name, (), value['count']))
+            res.append((mtr + '_' + self.gsum_name, (), value['sum']))
+            continue
+        return res
+
+    def point_names(self):
+        """Get the names that points() can yield."""
+        res = [ ]
+        for mtr, fmt, func, leaf in self.samples:
+            if not callable(fmt) or isinstance(fmt, NativeHistogram):
+                res.append(mtr)
+                continue
+            res.append(mtr + '_bucket')
+            res.append(mtr + '_' + self.gcount_name)
+            res.append(mtr + '_' + self.gsum_name)
+            continue
+        return res
+
+    def proto_layout(self):
+        """Get the layout of the family in the protobuf exposition
+        format.  Each sample becomes a separate MetricFamily, except
+        that the _created sample of a counter is attached to its other
+        samples.  A list of (sample position, metric type, serialized
+        MetricFamily header) tuples is returned.
+
+        """
+        if self.proto is not None:
+            return self.proto
+        import lancs_gridmon.metrics.client_model_pb2 as pb
+        res = [ ]
+        for si, (mtr, fmt, func, leaf) in enumerate(self.samples):
+            if self.type == 'counter':
+                if mtr == self.name + '_created':
+                    continue
+                typ = pb.COUNTER
+            elif callable(fmt):
+                typ = pb.GAUGE_HISTOGRAM if self.type == 'gaugehistogram' \
+                    else pb.HISTOGRAM
+            elif self.type == 'gauge':
+                typ = pb.GAUGE
+            else:
+                typ = pb.UNTYPED
+                pass
+            hdr = pb.MetricFamily(name=mtr, type=typ)
+            if self.help is not None:
+                hdr.help = self.help
+                pass
+            if self.unit is not None:
+                hdr.unit = self.unit
+                pass
+            res.append((si, typ, hdr.SerializeToString()))
+            continue
+        self.proto = res
+        return res
+
+    def __proto_metric(self, pb, typ, labels, k, value, created):
+        ## Serialize a single point as the 'metric' field of a
+        ## MetricFamily.  A histogram's value has already been
+        ## converted.
+        if value is None:
+            return None
+        msg = pb.MetricFamily()
+        met = msg.metric.add()
+        for name, lval in labels:
+            lp = met.label.add()
+            lp.name = name
+            lp.value = lval
+            continue
+        met.timestamp_ms = int(k * 1000)
+        if typ == pb.COUNTER:
+            met.counter.value = value
+            if created is not None:
+                met.counter.created_timestamp.FromNanoseconds(int(created *
+                                                                  1e9))
+                pass
+        elif typ == pb.GAUGE:
+            met.gauge.value = value
+        elif typ == pb.UNTYPED:
+            met.untyped.value = value
+        else:
+            ## A native histogram also carries classic buckets, for
+            ## scrapers that don't support it.
+            if isinstance(value, _NativeValue):
+                hist = met.histogram
+                hist.schema = value.schema
+                hist.zero_threshold = value.zero_threshold
+                hist.zero_count = value.zero_count
+                for buckets, spans, deltas in \
+                    ((value.positive, hist.positive_span, hist.positive_delta),
+                     (value.negative, hist.negative_span, hist.negative_delta)):
+                    sps, dts = value.spans(buckets)
+                    for offset, length in sps:
+                        sp = spans.add()
+                        sp.offset = offset
+                        sp.length = length
+                        continue
+                    deltas.extend(dts)
+                    continue
+                value = value.classic()
+                pass
+            thrs = [ thr for thr in value.keys()
+                     if isinstance(thr, (int, float)) ]
+            thrs.sort()
+            for thr in thrs:
+                bk = met.histogram.bucket.add()
+                bk.upper_bound = thr
+                bk.cumulative_count = int(value[thr])
+                continue
+            met.histogram.sample_count = int(value['count'])
+            met.histogram.sample_sum = value['sum']
+            pass
+        return msg.SerializeToString()
+
+    def proto_fragments(self, k, entry, over=None, fold=()):
+        """Render each series of the family at one timestamp in the
+        protobuf exposition format.  As with fragments(), a dict is
+        returned, but each series maps to a list with an element for
+        each entry of proto_layout(), either None or a serialized
+        'metric' field of a MetricFamily message.
+
+        """
+        import lancs_gridmon.metrics.client_model_pb2 as pb
+        layout = self.proto_layout()
+        created = None
+        if self.type == 'counter':
+            created = next((si for si, smp in enumerate(self.samples)
+                            if smp[0] == self.name + '_created'), None)
+            pass
+
+        res = { }
+        excess = [ ]
+        for tup, node in self.series(entry):
+            if over and tup in over:
+                if fold:
+                    excess.append((tup, node))
+                    pass
+                continue
+            labels = self.labels(tup, entry)
+            vals = [ func(tup, entry) if leaf is None or node is None
+                     else leaf(node)
+                     for mtr, fmt, func, leaf in self.samples ]
+            cval = None if created is None else vals[created]
+            frags = [ ]
+            for si, typ, hdr in layout:
+                value = vals[si]
+                fmt = self.samples[si][1]
+                if value is None:
+                    pass
+                elif isinstance(fmt, NativeHistogram):
+                    value = fmt.native(value)
+                elif callable(fmt):
+                    value = fmt(value)
+                    pass
+                frags.append(self.__proto_metric(pb, typ, labels, k,
+                                                 value, cval))
+                continue
+            res[tup] = frags
+            continue
+        if len(excess) == 0:
+            return res
+
+        for labels, points in self.fold(excess, entry, fold).items():
+            res[(_FOLDED, labels)] = self.proto_points(labels, points, k)
+            continue
+        return res
+
+    def proto_points(self, labels, points, k):
+        """Render points as yielded by points() or fold(), with the
+        given labels, at one timestamp, in the protobuf exposition
+        format.  A list of fragments is returned, as for each series
+        from proto_fragments().
+
+        """
+        import lancs_gridmon.metrics.client_model_pb2 as pb
+        created = None
+        if self.type == 'counter':
+            created = next((smp[0] for smp in self.samples
+                            if smp[0] == self.name + '_created'), None)
+            pass
+
+        ## Reassemble the sample values from the points.
+        vals = { }
+        for name, extra, value in points:
+            vals[(name, extra)] = value
+            continue
+        cval = None if created is None else vals.get((created, ()))
+        frags = [ ]
+        for si, typ, hdr in self.proto_layout():
+            mtr, fmt = self.samples[si][:2]
+            if not callable(fmt) or isinstance(fmt, NativeHistogram):
+                value = vals.get((mtr, ()))
+            else:
+                value = {
+                    'count': vals.get((mtr + '_' + self.gcount_name, ())),
+                    'sum': vals.get((mtr + '_' + self.gsum_name, ())),
+                }
+                for (name, extra), bv in vals.items():
+                    if name == mtr + '_bucket' and extra[0][1] != '+inf':
+                        value[float(extra[0][1])] = bv
+                        pass
+                    continue
+                if value['count'] is None:
+                    value = None
+                    pass
+                pass
+            frags.append(self.__proto_metric(pb, typ, labels, k, value, cval))
+            continue
+        return frags
+
+    def proto_message(self, frag_lists):
+        """Assemble lists of fragments from proto_fragments() into
+        varint-delimited MetricFamily messages.  Families with no
+        points are omitted.
+
+        """
+        res = [ ]
+        for li, (si, typ, hdr) in enumerate(self.proto_layout()):
+            parts = [ frags[li] for frags in frag_lists
+                      if frags[li] is not None ]
+            if len(parts) == 0:
+                continue
+            body = hdr + b''.join(parts)
+            res.append(_varint(len(body)))
+            res.append(body)
+            continue
+        return b''.join(res)
+
+    pass
+
+def _varint(n):
+    ## Encode a non-negative integer as a protobuf varint.
+    res = bytearray()
+    while n >= 0x80:
+        res.append((n & 0x7f) | 0x80)
+        n >>= 7
+        continue
+    res.append(n)
+    return bytes(res)
+
+def compile_schema(schema):
+    """Prepare a schema for repeated rendering.  Each metric-family
+    descriptor (see MetricHistory) is converted into an object with
+    its header lines, sample names and label functions resolved.
+    Already compiled families are passed through, so the result can
+    be shared by several MetricHistory and RemoteMetricsWriter
+    objects, or concatenated with other schemata.
+
+    """
+    return [ fam if isinstance(fam, _CompiledFamily) else _CompiledFamily(fam)
+             for fam in schema ]
+
+## Folded series are keyed by this and their labels, so they can't
+## be confused with series indices.
+_FOLDED = object()
+
+class _SeriesBudget:
+    """Limits the number of distinct series of a family.  Series are
+    admitted in the order they are first seen, until the limit is
+    reached.  An admitted series keeps its place until it has not been
+    seen for 'timeout' seconds, when its place can be taken by a new
+    series.  Series beyond the budget are dropped or, if 'fold' names
+    some labels, folded (see _CompiledFamily.fold()).
+
+    """
+
+    def __init__(self, limit, fold=(), timeout=30*60):
+        self.limit = limit
+        self.fold = frozenset(fold)
+        self.timeout = timeout
+        self.admitted = { }
+        pass
+
+    def partition(self, tups, k):
+        """Admit series indices seen at time 'k', and return the set of
+        those over the budget.
+
+        """
+        over = set()
+        swept = False
+        for tup in tups:
+            seen = self.admitted.get(tup)
+            if seen is not None:
+                if k > seen:
+                    self.admitted[tup] = k
+                    pass
+                continue
+            if len(self.admitted) >= self.limit and not swept:
+                ## Free the places of series that have gone away.
+                threshold = k - self.timeout
+                self.admitted = { t: s for t, s in self.admitted.items()
+                                  if s >= threshold }
+                swept = True
+                pass
+            if len(self.admitted) < self.limit:
+                self.admitted[tup] = k
+            else:
+                over.add(tup)
+                pass
+            continue
+        return over
+
+    pass
+
+def _series_budgets(schema, budgets):
+    ## Map the index of each family with a budget to a _SeriesBudget.
+    ## 'budgets' maps a family's base name to its limit, or to a dict
+    ## of the limit and optional 'fold' and 'timeout'.
+    res = { }
+    if budgets is None:
+        return res
+    for fi, fam in enumerate(schema):
+        spec = budgets.get(fam.base)
+        if spec is None:
+            continue
+        if not isinstance(spec, dict):
+            spec = { 'limit': spec }
+            pass
+        res[fi] = _SeriesBudget(**spec)
+        continue
+    return res
+
+## The number of series of each budgeted family that were dropped or
+## folded is reported with this family, selecting from a dict of
+## counts by family name.
+_overflow_family = _CompiledFamily({
+    'base': 'gridmon_series_overflow',
+    'type': 'gauge',
+    'help': 'series beyond the family budget, dropped or folded',
+    'select': lambda e: [ (base,) for base in e ],
+    'samples': {
+        '': ('%d', lambda t, d: d[t[0]]),
+    },
+    'attrs': {
+        'family': ('%s', lambda t, d: t[0]),
+    },
+})
+
+## Exporters record how long their own work takes, with these bucket
+## thresholds in seconds and bytes.
+_time_bounds = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+_size_bounds = tuple(1024 * 4 ** i for i in range(9))
+
+class _Histogram:
+    """A cumulative histogram of observations, with fixed thresholds.
+    Its value is in the form yielded by a histogram converter (see
+    MetricHistory).
+
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [ 0 ] * len(bounds)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+        pass
+
+    def observe(self, value):
+        pos = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            if pos < len(self.counts):
+                self.counts[pos] += 1
+                pass
+            self.count += 1
+            self.sum += value
+            pass
+        pass
+
+    def value(self):
+        with self.lock:
+            res = { }
+            tot = 0
+            for thr, cnt in zip(self.bounds, self.counts):
+                tot += cnt
+                res[thr] = tot
+                continue
+            res['count'] = self.count
+            res['sum'] = self.sum
+            pass
+        return res
+
+    pass
+
+class _Counter:
+    """A count, which also serves as a gauge if it is decreased."""
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+        pass
+
+    def inc(self, n=1):
+        with self.lock:
+            self.count += n
+            pass
+        pass
+
+    def value(self):
+        with self.lock:
+            return self.count
+        pass
+
+    pass
+
+class _Since:
+    """The time since an event, as a gauge.  It has no value until the
+    event has first happened.
+
+    """
+
+    def __init__(self):
+        self.when = None
+        pass
+
+    def mark(self):
+        self.when = time.time()
+        pass
+
+    def value(self):
+        if self.when is None:
+            return None
+        return time.time() - self.when
+
+    pass
+
+class _Instruments:
+    """Measurements of the exporter's own work, shared by all
+    MetricHistory and RemoteMetricsWriter objects in the process.
+    Each instrument is identified by a family's base name and a
+    tuple of label name-value pairs, and is created on first use.
+    Each family has a compiled schema entry, selecting from a
+    snapshot mapping base name to a dict from labels to value.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families = { }
+        self.members = { }
+        pass
+
+    def __get(self, spec, labels, make):
+        base = spec['base']
+        labels = tuple(sorted(labels.items()))
+        with self.lock:
+            fam = self.families.get(base)
+            if fam is None:
+                spec = dict(spec)
+                spec['select'] = lambda e: [ (lt,) for lt in e.get(base, ()) ]
+                spec['attrs'] = { '': lambda t, d: dict(t[0]) }
+                fam = self.families[base] = _CompiledFamily(spec)
+                self.members[base] = { }
+                pass
+            members = self.members[base]
+            inst = members.get(labels)
+            if inst is None:
+                inst = members[labels] = make()
+                pass
+            pass
+        return inst
+
+    def histogram(self, base, unit, help, bounds, labels=dict()):
+        """Get a histogram."""
+        spec = {
+            'base': base,
+            'type': 'histogram',
+            'unit': unit,
+            'help': help,
+            'samples': {
+                '': (lambda v: v, lambda t, d: d[base][t[0]]),
+            },
+            'sum_format': '%.6f',
+        }
+        return self.__get(spec, labels, lambda: _Histogram(bounds))
+
+    def counter(self, base, help, labels=dict()):
+        """Get a counter."""
+        spec = {
+            'base': base,
+            'type': 'counter',
+            'help': help,
+            'samples': {
+                '_total': ('%d', lambda t, d: d[base][t[0]]),
+            },
+        }
+        return self.__get(spec, labels, _Counter)
+
+    def gauge(self, base, unit, help, labels=dict()):
+        """Get a gauge, which is increased and decreased, rather than
+        set, so that several users can share it.
+
+        """
+        spec = {
+            'base': base,
+            'type': 'gauge',
+            'unit': unit,
+            'help': help,
+            'samples': {
+                '': ('%d', lambda t, d: d[base][t[0]]),
+            },
+        }
+        return self.__get(spec, labels, _Counter)
+
+    def since(self, base, help, labels=dict()):
+        """Get a gauge of the time in seconds since it was last
+        marked.
+
+        """
+        spec = {
+            'base': base,
+            'type': 'gauge',
+            'unit': 'seconds',
+            'help': help,
+            'samples': {
+                '': ('%.3f', lambda t, d: d[base][t[0]]),
+            },
+        }
+        return self.__get(spec, labels, _Since)
+
+    def schema(self, bases=None):
+        """Get the compiled schema entries of the named families, or
+        of all families.
+
+        """
+        with self.lock:
+            return [ fam for base, fam in self.families.items()
+                     if bases is None or base in bases ]
+        pass
+
+    def snapshot(self, only=None):
+        """Get the current values of all instruments, or only of those
+        in a collection.  Instruments without a value yet are left
+        out.
+
+        """
+        with self.lock:
+            members = { base: dict(insts)
+                        for base, insts in self.members.items() }
+            pass
+        res = { }
+        for base, insts in members.items():
+            vals = res[base] = { }
+            for labels, inst in insts.items():
+                if only is not None and inst not in only:
+                    continue
+                value = inst.value()
+                if value is not None:
+                    vals[labels] = value
+                    pass
+                continue
+            continue
+        return res
+
+    pass
+
+_instruments = _Instruments()
+
+
+## The columnar store keeps up to twice this many recent points of
+## each series in plain arrays.  When that is reached, the older half
+## is sealed into an encoded chunk.
+_CHUNK_POINTS = 120
+
+_NAN = float('nan')
+
+def _read_varint(buf, pos):
+    ## Decode a varint from bytes at a position, returning the value
+    ## and the next position.
+    res = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        res |= (b & 0x7f) << shift
+        if b < 0x80:
+            return res, pos
+        shift += 7
+        continue
+    pass
+
+def _encode_times(times):
+    ## Encode timestamps as varints of the zigzagged differences
+    ## between successive differences, in milliseconds.  Regular
+    ## intervals then take one byte per point.
+    res = bytearray()
+    prev = 0
+    delta = 0
+    for t in times:
+        ms = int(round(t * 1000))
+        dod = ms - prev - delta
+        res += _varint(dod * 2 if dod >= 0 else -dod * 2 - 1)
+        delta = ms - prev
+        prev = ms
+        continue
+    return bytes(res)
+
+def _decode_times(buf, n):
+    res = array('d')
+    pos = 0
+    prev = 0
+    delta = 0
+    for _ in range(n):
+        zz, pos = _read_varint(buf, pos)
+        delta += (zz >> 1) ^ -(zz & 1)
+        prev += delta
+        res.append(prev / 1000)
+        continue
+    return res
+
+def _encode_values(values):
+    ## Encode values by the bits differing from the previous value.
+    ## An unchanged value takes one byte.  Otherwise, the trailing
+    ## zero bits of the difference are counted in the low six bits of
+    ## a varint, and removed from the rest, so a value close to its
+    ## predecessor takes a few bytes.
+    bits = array('Q')
+    bits.frombytes(values.tobytes())
+    res = bytearray()
+    prev = 0
+    for b in bits:
+        x = b ^ prev
+        prev = b
+        if x == 0:
+            res.append(0)
+            continue
+        tz = (x & -x).bit_length() - 1
+        res += _varint(((x >> tz) << 6) | tz)
+        continue
+    return bytes(res)
+
+def _decode_values(buf, n):
+    bits = array('Q')
+    pos = 0
+    prev = 0
+    for _ in range(n):
+        v, pos = _read_varint(buf, pos)
+        if v != 0:
+            prev ^= (v >> 6) << (v & 0x3f)
+            pass
+        bits.append(prev)
+        continue
+    res = array('d')
+    res.frombytes(bits.tobytes())
+    return res
+
+class _Columns:
+    """The points of one series, held as an array of timestamps, and
+    a parallel array of values for each point name.  Absent values
+    are NaN.  Older points are sealed into chunks, each a tuple of the
+    first and last timestamps, the number of points, the encoded
+    timestamps, and a list of encoded values of each column that
+    existed when the chunk was sealed.
+
+    Arrays, lists and chunks are only ever appended to in place,
+    otherwise being replaced, so a snapshot can keep referring to
+    them without the lock, reading only as many elements as there
+    were when it was taken.
+
+    """
+
+    __slots__ = ('labels', 'names', 'index', 'ints', 'times', 'values',
+                 'chunks')
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.names = [ ]
+        self.index = { }
+        self.ints = [ ]
+        self.times = array('d')
+        self.values = [ ]
+        self.chunks = ()
+        pass
+
+    def add(self, k, points, mismatch):
+        """Add points as yielded by _CompiledFamily.points() at time 'k'.
+        'mismatch' is as for MetricHistory.install().
+
+        """
+        ## Convert the points to a row of values by column.  A column
+        ## whose values have all been integers yields integers.
+        row = { }
+        for name, extra, value in points:
+            if value is None:
+                continue
+            key = (name, extra)
+            ci = self.index.get(key)
+            if ci is None:
+                ci = self.index[key] = len(self.names)
+                self.values.append(array('d', [ _NAN ]) * len(self.times))
+                self.ints.append(True)
+                self.names.append(key)
+                pass
+            if self.ints[ci] and not isinstance(value, int):
+                ## Replace the flags, rather than changing them under
+                ## a snapshot.
+                self.ints = list(self.ints)
+                self.ints[ci] = False
+                pass
+            row[ci] = float(value)
+            continue
+
+        ## Points usually arrive in order, and are appended.
+        last = self.times[-1] if len(self.times) > 0 else \
+            self.chunks[-1][1] if len(self.chunks) > 0 else None
+        if last is not None and k <= last:
+            self.__rewrite(k, row, mismatch)
+            return
+        self.times.append(k)
+        for ci, col in enumerate(self.values):
+            col.append(row.get(ci, _NAN))
+            continue
+        if len(self.times) >= 2 * _CHUNK_POINTS:
+            self.__seal()
+            pass
+        pass
+
+    def __rewrite(self, k, row, mismatch):
+        ## Unseal the chunks from the first that could hold k, and
+        ## merge the row in, building new arrays.
+        cut = bisect.bisect_left([ ch[1] for ch in self.chunks ], k)
+        times, cols = self.decode(self.chunks[cut:], self.times,
+                                  len(self.times), self.values,
+                                  len(self.names))
+        times = list(times)
+        cols = [ list(col) for col in cols ]
+        pos = bisect.bisect_left(times, k)
+        if pos < len(times) and times[pos] == k:
+            for ci, value in row.items():
+                old = cols[ci][pos]
+                if old != old or mismatch > 0:
+                    cols[ci][pos] = value
+                elif mismatch == 0 and old != value:
+                    raise Exception('bad merge (%s over %s at %s)' %
+                                    (value, old, self.names[ci][0]))
+                continue
+        else:
+            times.insert(pos, k)
+            for ci, col in enumerate(cols):
+                col.insert(pos, row.get(ci, _NAN))
+                continue
+            pass
+        self.chunks = self.chunks[:cut]
+        self.times = array('d', times)
+        self.values = [ array('d', col) for col in cols ]
+        while len(self.times) >= 2 * _CHUNK_POINTS:
+            self.__seal()
+            continue
+        pass
+
+    def __seal(self):
+        ## Encode the oldest points as a chunk.
+        n = _CHUNK_POINTS
+        chunk = (self.times[0], self.times[n - 1], n,
+                 _encode_times(self.times[:n]),
+                 [ _encode_values(col[:n]) for col in self.values ])
+        self.chunks = self.chunks + (chunk,)
+        self.times = self.times[n:]
+        self.values = [ col[n:] for col in self.values ]
+        pass
+
+    def expire(self, threshold):
+        """Discard points before 'threshold'.  Chunks are only
+        discarded once all their points have expired.  True is returned
+        if no points remain.
+
+        """
+        cut = 0
+        while cut < len(self.chunks) and self.chunks[cut][1] < threshold:
+            cut += 1
+            continue
+        if cut > 0:
+            self.chunks = self.chunks[cut:]
+            pass
+        if len(self.times) > 0 and self.times[0] < threshold:
+            pos = bisect.bisect_left(self.times, threshold)
+            self.times = self.times[pos:]
+            self.values = [ col[pos:] for col in self.values ]
+            pass
+        return len(self.chunks) == 0 and len(self.times) == 0
+
+    @staticmethod
+    def decode(chunks, times, n, values, ncols):
+        """Get the timestamps and columns of chunks, followed by the
+        first 'n' points of the recent arrays, which have 'ncols'
+        columns.  An array of timestamps and a list of value arrays
+        are returned.
+
+        """
+        res_times = array('d')
+        res_cols = [ array('d') for _ in range(ncols) ]
+        for first, last, cn, tbuf, vbufs in chunks:
+            res_times.extend(_decode_times(tbuf, cn))
+            for ci, col in enumerate(res_cols):
+                if ci < len(vbufs):
+                    col.extend(_decode_values(vbufs[ci], cn))
+                else:
+                    col.extend(array('d', [ _NAN ]) * cn)
+                    pass
+                continue
+            continue
+        res_times.extend(times[:n])
+        for ci, col in enumerate(res_cols):
+            col.extend(values[ci][:n])
+            continue
+        return res_times, res_cols
+
+    def snapshot(self):
+        """Capture the current points, so they can be read without
+        the lock by rows().
+
+        """
+        return (self.labels, self.names, self.ints, len(self.names),
+                self.chunks, self.times, len(self.times), self.values)
+
+    @staticmethod
+    def rows(snap, after, lo):
+        """Yield each point time later than 'after' and no earlier than
+        'lo' of a snapshot, with a list of (name, extra labels, value)
+        tuples, as from _CompiledFamily.points().
+
+        """
+        labels, names, ints, ncols, chunks, times, n, values = snap
+        first = max(after, lo)
+        chunks = [ ch for ch in chunks if ch[1] >= first ]
+        if len(chunks) == 0 and (n == 0 or times[n - 1] < first):
+            return
+        cols = values
+        if len(chunks) > 0:
+            times, cols = _Columns.decode(chunks, times, n, values, ncols)
+            n = len(times)
+            pass
+        for i in range(bisect.bisect_left(times, first, 0, n), n):
+            k = times[i]
+            if k <= after:
+                continue
+            pts = [ ]
+            for ci in range(ncols):
+                value = cols[ci][i]
+                if value != value:
+                    continue
+                name, extra = names[ci]
+                pts.append((name, extra, int(value) if ints[ci] else value))
+                continue
+            yield k, pts
+            continue
+        pass
+
+    pass
+
+class _ColumnStore:
+    """Holds the points of each series of each family of a schema as
+    _Columns.  Entries are reduced to points on installation, and
+    can then be discarded.  Series are keyed by their labels, interned
+    so that each distinct set is kept once.
+
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.families = [ { } for _ in schema ]
+        self.interned = { }
+        pass
+
+    def add(self, fi, labels, k, points, mismatch):
+        """Add the points of a series of family 'fi' at time 'k'."""
+        labels = tuple(labels)
+        cols = self.families[fi].get(labels)
+        if cols is None:
+            labels = self.interned.setdefault(labels, labels)
+            cols = self.families[fi][labels] = _Columns(labels)
+            pass
+        cols.add(k, self.schema[fi].classic_points(points), mismatch)
+        pass
+
+    def expire(self, threshold):
+        """Discard points before 'threshold', and series with no
+        remaining points.
+
+        """
+        for fam in self.families:
+            for labels in [ labels for labels, cols in fam.items()
+                            if cols.expire(threshold) ]:
+                del fam[labels]
+                continue
+            continue
+        live = set()
+        for fam in self.families:
+            live.update(fam)
+            continue
+        if len(live) < len(self.interned):
+            self.interned = { labels: labels for labels in live }
+            pass
+        pass
+
+    def snapshot(self, fi):
+        """Capture the series of family 'fi'."""
+        return [ cols.snapshot() for cols in self.families[fi].values() ]
+
+    pass
 
 class MetricHistory:
     """Keeps track of timestamped metrics in a thread-safe way.  Metrics
@@ -89,7 +1478,8 @@ class MetricHistory:
 
     """
 
-    def __init__(self, schema, horizon=60*30):
+    def __init__(self, schema, horizon=60*30, budgets=None, engine='tree',
+                 max_bytes=None, clock=time.time):
         """The schema is an array of metric family descriptors.  Each is a
         dict with an entry 'base' giving the base name of the family;
         optional 'type' (e.g., 'counter', 'gauge', etc, as specified
@@ -99,6 +1489,8 @@ class MetricHistory:
         metric within the entry; 'samples' as a dict mapping from name
         suffix to a tuple of (format specifier, value function); and
         'attrs' as a dict from attribute name to value function.
+        Sums of histograms are rendered as integers, unless an
+        optional 'sum_format' gives another format specifier.
 
         A selection function is provided with a dict d, a complete
         entry for a timestamp.  It should return a list of tuples
@@ -131,13 +1523,113 @@ class MetricHistory:
         can be greater than the last real entry, if the last bucket
         has no upper bound.
 
+        The schema is prepared with compile_schema(), unless that has
+        already been done.
+
+        'budgets' optionally limits the number of series of some
+        families.  It maps a family's base name to the maximum number
+        of series, or to a dict with 'limit', and optionally 'fold' as
+        a list of label names and 'timeout' in seconds.  Series beyond
+        the limit are dropped, or, if 'fold' is given, combined into
+        series with those labels set to 'other', their values summed.
+        A series keeps its place until it has not been seen for the
+        timeout (30 minutes by default).  The number of series beyond
+        each family's limit at each timestamp is reported as
+        gridmon_series_overflow.
+
+        'engine' selects how entries are stored.  'tree' keeps each
+        installed entry, merged with any earlier one with the same
+        timestamp.  'columnar' instead reduces each entry to its
+        series' points when installed, and keeps each series as arrays
+        of timestamps and values, encoding older points compactly.
+        This uses much less memory when the same series recur at many
+        timestamps, but requires all sample values to be numeric, and
+        presents native histograms as classic ones.  Points are merged
+        individually, so an entry installed in parts must have each
+        series' data in one part.
+
+        'max_bytes' optionally limits the estimated size of the
+        entries held.  When it is exceeded, the oldest timestamps are
+        discarded before the horizon, though the latest is always
+        kept.  The size of an entry is estimated as by tree_size(),
+        kept up to date as data is merged into it.  With the columnar
+        engine, each point is estimated to take 16 bytes.  The
+        estimated sizes of all histories are reported as
+        gridmon_history_bytes, and the number of timestamps discarded
+        to stay within the limits as gridmon_history_evictions_total.
+
+        'clock' returns the current time in seconds, against which the
+        horizon is applied.
+
         """
+        if engine not in ('tree', 'columnar'):
+            raise ValueError('unknown engine: %s' % engine)
         self.timestamps = { }
         self.horizon = horizon
-        self.schema = schema
+        self.clock = clock
+        self.schema = compile_schema(schema)
         self.running = True
         self.lock = threading.Lock()
         self.entries = { }
+
+        ## With the columnar engine, the points are kept in 'store',
+        ## and 'entries' only records which timestamps are held,
+        ## mapping each to None.
+        self.store = _ColumnStore(self.schema) \
+            if engine == 'columnar' else None
+
+        ## The timestamps of the entries are kept in ascending order
+        ## from index 'times_head'.  Expired timestamps before that
+        ## index are only removed once they make up half the list.
+        self.times = [ ]
+        self.times_head = 0
+
+        ## The estimated size of each entry is kept by timestamp, and
+        ## in total.
+        self.max_bytes = max_bytes
+        self.sizes = { }
+        self.total_size = 0
+
+        ## Rendered text is cached by timestamp, then by family index
+        ## and format, then by series index, so that clients scraping
+        ## the same entries share the work.  Each timestamp's cache is paired
+        ## with the entry it was rendered from.
+        self.fragments = { }
+
+        ## Series beyond the budgets are identified on installation,
+        ## and the sets of their indices are kept by timestamp, then
+        ## by family index.
+        self.budgets = _series_budgets(self.schema, budgets)
+        self.overflow = { }
+
+        ## The time taken to get the lock, to merge installed data,
+        ## and to render scrape responses are recorded, and served
+        ## with the time spent by any remote writers.
+        self.lock_wait = _instruments.histogram(
+            'gridmon_history_lock_wait', 'seconds',
+            'time waiting for the history lock', _time_bounds)
+        self.merge_time = _instruments.histogram(
+            'gridmon_history_merge', 'seconds',
+            'time merging installed data into the history', _time_bounds)
+        self.render_time = _instruments.histogram(
+            'gridmon_scrape_render', 'seconds',
+            'time rendering scrape responses', _time_bounds)
+        self.usage = _instruments.gauge(
+            'gridmon_history', 'bytes',
+            'estimated size of the entries held for scraping')
+        self.evictions = _instruments.counter(
+            'gridmon_history_evictions',
+            'timestamps discarded to stay within the size limit')
+        pass
+
+    @contextlib.contextmanager
+    def __locked(self):
+        ## Hold the lock, recording how long it took to get.
+        start = time.perf_counter()
+        with self.lock:
+            self.lock_wait.observe(time.perf_counter() - start)
+            yield
+            pass
         pass
 
     def install(self, samples, mismatch=0):
@@ -147,217 +1639,335 @@ class MetricHistory:
         silently avoid replacing values, positive to silently override
         old values, and zero (default) to raise an exception.
 
+        Existing entries are never modified.  Instead, a merged copy
+        replaces each affected entry, so renderers can continue to
+        use the old entries without holding the lock.
+
         """
-        with self.lock:
+        with self.__locked():
             ## Identify times which can be discarded.
-            threshold = int(time.time()) - self.horizon
-
-            ## Merge the new data with the old.
-            merge_trees(self.entries, samples, mismatch=mismatch)
+            threshold = int(self.clock()) - self.horizon
+
+            ## Merge the new data with the old.  Any text already
+            ## rendered from the affected entries is now stale.
+            start = time.perf_counter()
+            if self.store is None:
+                merged = { }
+                growth = { }
+                for k, v in samples.items():
+                    old = self.entries.get(k)
+                    if old is None:
+                        merged[k] = v
+                        growth[k] = tree_size(v)
+                    else:
+                        merged[k] = merged_trees(old, v, (k,),
+                                                 mismatch=mismatch)
+                        growth[k] = merged_size(old, v)
+                        pass
+                    continue
+            else:
+                merged, growth = self.__resolve(samples, mismatch)
+                pass
+            for k, size in growth.items():
+                self.sizes[k] = self.sizes.get(k, 0) + size
+                self.total_size += size
+                self.usage.inc(size)
+                continue
+            for k, v in merged.items():
+                if k not in self.entries:
+                    ## New timestamps are usually the latest.
+                    if len(self.times) == self.times_head or \
+                       k > self.times[-1]:
+                        self.times.append(k)
+                    else:
+                        bisect.insort(self.times, k, lo=self.times_head)
+                        pass
+                    pass
+                self.entries[k] = v
+                self.fragments.pop(k, None)
+                continue
+            self.merge_time.observe(time.perf_counter() - start)
+
+            ## Admit new series to the budgets in time order.  The
+            ## columnar engine has already done so.
+            for k in sorted(merged) \
+                if self.budgets and self.store is None else ():
+                entry = merged[k]
+                self.overflow[k] = {
+                    fi: budget.partition(self.schema[fi].select(entry), k)
+                    for fi, budget in self.budgets.items()
+                }
+                continue
 
-            ## Discard old entries.
-            for k in [ k for k in self.entries if k < threshold ]:
+            ## Discard old entries, and then the oldest remaining
+            ## entries until the total size is within the limit.
+            cut = bisect.bisect_left(self.times, threshold, lo=self.times_head)
+            total = self.total_size - \
+                sum(self.sizes[k] for k in self.times[self.times_head:cut])
+            if self.max_bytes is not None:
+                evicted = cut
+                while total > self.max_bytes and cut + 1 < len(self.times):
+                    total -= self.sizes[self.times[cut]]
+                    cut += 1
+                    continue
+                if cut > evicted:
+                    self.evictions.inc(cut - evicted)
+                    pass
+                pass
+            for k in self.times[self.times_head:cut]:
                 del self.entries[k]
+                self.fragments.pop(k, None)
+                self.overflow.pop(k, None)
+                self.sizes.pop(k)
                 continue
+            self.usage.inc(total - self.total_size)
+            self.total_size = total
+            if self.store is not None and cut > self.times_head:
+                self.store.expire(self.times[cut] if cut < len(self.times)
+                                  else threshold)
+                pass
+            self.times_head = cut
+            if self.times_head * 2 > len(self.times):
+                del self.times[:self.times_head]
+                self.times_head = 0
+                pass
         pass
 
-    def __sample(self, k, tup, mtr, fmt, func, attrs, gcount_name, gsum_name):
-        entry = self.entries[k]
-        value = func(tup, entry)
-
-        ## Each element of attrs gives the attribute name, the format
-        ## specifier, and a function to provide the value.  The
-        ## function is provided with the tuple that identifies the
-        ## metric, and the data at the given timestamp k.
-        labels = []
-        if attrs is None:
-            attrs = { }
-            pass
-        for an, vspec in attrs.items():
-            if callable(vspec):
-                ## vspec is to be called with the entry details, and
-                ## yields multiple key-value pairs.
-                for ansfx, lval in vspec(tup, entry).items():
-                    if lval is not None:
-                        labels.append(('%s="%s"') % (an + ansfx, lval))
-                        pass
+    def __resolve(self, samples, mismatch):
+        ## Add the points of each series of each entry to the columnar
+        ## store, applying the budgets.  The timestamps are returned,
+        ## mapped to no entries, along with the estimated growth of
+        ## each.
+        growth = { }
+        for k in sorted(samples):
+            entry = samples[k]
+            size = 0
+            over = self.overflow.setdefault(k, { }) if self.budgets else None
+            for fi, fam in enumerate(self.schema):
+                budget = self.budgets.get(fi)
+                excess = None
+                if budget is not None:
+                    excess = budget.partition(fam.select(entry), k)
+                    over[fi] = over.get(fi, set()) | excess
+                    pass
+                folded = [ ]
+                for tup, node in fam.series(entry):
+                    if excess and tup in excess:
+                        if budget.fold:
+                            folded.append((tup, node))
+                            pass
+                        continue
+                    points = fam.points(tup, entry, node)
+                    self.store.add(fi, fam.labels(tup, entry), k, points,
+                                   mismatch)
+                    size += 16 * len(points)
+                    continue
+                if len(folded) == 0:
+                    continue
+                for labels, points in \
+                    fam.fold(folded, entry, budget.fold).items():
+                    self.store.add(fi, labels, k, points, mismatch)
+                    size += 16 * len(points)
                     continue
                 continue
-
-            vspec = _get_sample_func(vspec)
-            ## The first element of vspec is a format string,
-            ## containing len(vspec)-1 format specifiers.  The
-            ## remaining elements are functions to be supplied with
-            ## details of the entry being rendered.  The functions'
-            ## values are used to fulfil the format specifiers.
-            lval = _safe_mod(vspec, tup, entry)
-
-            ## Create a name-value pair to form a label.  TODO: Escape
-            ## the value.  TODO: Sanity-check the name.
-            if lval is not None:
-                labels.append(('%s="%s"') % (an, lval))
-                pass
+            growth[k] = size
             continue
+        return { k: None for k in samples }, growth
 
-        msg = ''
-
-        if callable(fmt):
-            ## Treat the extracted value as histogram data, and
-            ## convert it into a dict of 'sum' (the sum of the events'
-            ## values), 'count' (the number of events), with the
-            ## remaining keys being int/float thresholds giving the
-            ## cummulative contents of each bucket.  The first entry
-            ## must be 0.
-            value = fmt(value)
-
-            ## Extract the summary data.
-            gsum = value['sum']
-            gcount = value['count']
-
-            ## Extract and sort the thresholds.
-            thrs = [ thr for thr in value.keys()
-                     if isinstance(thr, (int,float)) ]
-            thrs.sort()
-
-            ## Generate the buckets.
-            for thr in thrs:
-                msg += mtr + "_bucket"
-                msg += '{'
-                msg += ','.join(labels + [ 'le="%g"' % thr ])
-                msg += '}'
-                msg += (' %d %.3f\n') % (value[thr], k)
-                continue
-
-            ## The +inf bucket and the count are the same.
-            msg += mtr + "_bucket"
-            msg += '{'
-            msg += ','.join(labels + [ 'le="+inf"' ])
-            msg += '}'
-            msg += (' %d %.3f\n') % (gcount, k)
-            msg += mtr + "_" + gcount_name
-            msg += '{'
-            msg += ','.join(labels)
-            msg += '}'
-            msg += (' %d %.3f\n') % (gcount, k)
-
-            msg += mtr + "_" + gsum_name
-            msg += '{'
-            msg += ','.join(labels)
-            msg += '}'
-            msg += (' %d %.3f\n') % (gsum, k)
-        else:
-            ## The metric is a single value, not a histogram.
-            msg += mtr
-            msg += '{'
-            msg += ','.join(labels)
-            msg += '}'
-            msg += (' ' + fmt + ' %.3f\n') % (value, k)
-            pass
-
-        return msg
-
-    def __family(self, ks, se):
-        mtr = se['base']
-        sel = se['select']
-        bits = se['samples']
-        hlp = se.get('help')
-        unit = se.get('unit')
-        typ = se.get('type')
-        attrs = se.get('attrs')
-
-        gcount_name = 'gcount' if typ == 'gaugehistogram' else 'count'
-        gsum_name = 'gsum' if typ == 'gaugehistogram' else 'sum'
-
-        ## The name of a metric with a unit should end with the unit.
-        if unit is not None:
-            mtr += '_' + unit
-            pass
+    def __family(self, snap, overflow, fi, proto):
+        fam = self.schema[fi]
+        budget = self.budgets.get(fi)
+        render = fam.proto_fragments if proto else fam.fragments
+        key = (fi, proto)
 
         ## Within this family, build up an index by metric (identified
-        ## by a tuple), and list the timestamps that contribute points
-        ## to that metric.
-        tses_for_tup = { }
-        for k in ks:
-            entry = self.entries.get(k)
-            if entry is None:
-                continue
-            for tup in sel(entry):
-                kset = tses_for_tup.setdefault(tup, set())
-                kset.add(k)
+        ## by a tuple), and list the rendered points contributing to
+        ## that metric.  Entries are rendered only if no other client
+        ## has already caused them to be.
+        texts_for_tup = { }
+        for k, entry in snap:
+            cached = self.fragments.get(k)
+            frags = None
+            if cached is not None and cached[0] is entry:
+                frags = cached[1].get(key)
+                pass
+            if frags is None:
+                if budget is None:
+                    frags = render(k, entry)
+                else:
+                    frags = render(k, entry, overflow[k][fi], budget.fold)
+                    pass
+
+                ## Keep the result only if the entry is still current.
+                with self.lock:
+                    if self.entries.get(k) is entry:
+                        cached = self.fragments.get(k)
+                        if cached is None or cached[0] is not entry:
+                            cached = self.fragments[k] = (entry, { })
+                            pass
+                        cached[1][key] = frags
+                        pass
+                    pass
+                pass
+            for tup, text in frags.items():
+                texts_for_tup.setdefault(tup, [ ]).append(text)
                 continue
             continue
-
-        ## Start the message with metadata.
-        msg = ''
-        if typ is not None:
-            msg += '# TYPE %s %s\n' % (mtr, typ)
-            pass
-        if unit is not None:
-            msg += '# UNIT %s %s\n' % (mtr, unit)
-            pass
-        if hlp is not None:
-            ## TODO: Escape the message.
-            msg += '# HELP %s %s\n' % (mtr, hlp)
-            pass
-
-        for tup, kset in tses_for_tup.items():
-            ## Get timestamps in order.
-            kseq = list(kset)
-            kseq.sort()
-
-            ## Do each metric point.
-            for k in kseq:
-                ## Do each metric sample.
-                for sfx, xxx in bits.items():
-                    fmt, func = _get_sample_func(xxx)
-                    msg += self.__sample(k, tup, mtr + sfx,
-                                         fmt, _safe_func(func), attrs,
-                                         gcount_name, gsum_name)
-                    continue
-                continue
+        return self.__assemble(fam, texts_for_tup, proto)
+
+    def __assemble(self, fam, texts_for_tup, proto):
+        ## Start the message with metadata, then do each point of each
+        ## metric.  In the protobuf format, the family yields a
+        ## message for each of its samples instead.
+        if proto:
+            return fam.proto_message([ frags
+                                       for texts in texts_for_tup.values()
+                                       for frags in texts ])
+        parts = [ fam.header ]
+        for texts in texts_for_tup.values():
+            parts.extend(texts)
             continue
+        return ''.join(parts)
 
-        return msg
-
-    def get_message(self, ident):
+    def stream_message(self, ident, proto=False):
         """Get the latest data for a given client, in OpenMetrics format.  A
         timestamp is recorded for each client, and only data newer
         than this timestamp is returned.  The timestamp is then
         updated to the most recent metric point just delivered,
         preventing metrics from being retransmitted.
 
-        """
-        msg = ''
+        If 'proto' is true, the message is in the Prometheus protobuf
+        exposition format instead, as bytes of varint-delimited
+        MetricFamily messages.  This requires the generated module
+        lancs_gridmon.metrics.client_model_pb2.
 
-        with self.lock:
+        A tuple of the client's previous timestamp, its new
+        timestamp, and a generator is returned.  The generator yields
+        the message one family at a time, each rendered as it is
+        requested.  It renders a snapshot of the entries taken by
+        this call, so it does not hold the lock, and is not affected
+        by later installations.
+
+        """
+        with self.__locked():
             ## Get the timestamp for this client.
             ts = self.timestamps.setdefault(ident, 0)
 
             ## Identify the most recent entries that the client has
-            ## not yet seen.  These are sorted to ensure all metrics
+            ## not yet seen.  These are in order to ensure all metrics
             ## come out in the same order.
-            ks = [ k for k in self.entries if k > ts ]
-            ks.sort()
+            first = bisect.bisect_right(self.times, ts, lo=self.times_head)
+            ks = self.times[first:]
+            snap = [ (k, self.entries[k]) for k in ks ]
+            overflow = { k: self.overflow[k] for k in ks } \
+                if self.budgets else None
+
+            ## The columnar engine's series are captured instead, to
+            ## be read from the oldest timestamp held.
+            columns = None
+            if self.store is not None and len(ks) > 0:
+                columns = (ts, self.times[self.times_head],
+                           [ self.store.snapshot(fi)
+                             for fi in range(len(self.schema)) ])
+                pass
 
             ## Identify the latest time of all matching entries and
             ## the caller's timestamp.
             latest = ts if len(ks) == 0 else max(ts, ks[-1])
 
-            ## Build up a message with any data that has arrived since
-            ## ts.
-            for ms in self.schema:
-                msg += self.__family(ks, ms)
-                continue
-
-            ## Complete the message.
-            msg += '# EOF\n'
-
             ## Prevent sending these metrics to the client again.
             self.timestamps[ident] = latest
+            pass
+
+        return (ts, latest, self.__stream(snap, overflow, columns, proto))
+
+    def __overflow(self, snap, overflow, proto):
+        ## Report the number of series beyond each budget.
+        fam = _overflow_family
+        render = fam.proto_fragments if proto else fam.fragments
+        texts_for_tup = { }
+        for k, _ in snap:
+            counts = { self.schema[fi].base: len(over)
+                       for fi, over in overflow[k].items() }
+            for tup, text in render(k, counts).items():
+                texts_for_tup.setdefault(tup, [ ]).append(text)
+                continue
+            continue
+        return self.__assemble(fam, texts_for_tup, proto)
+
+    def __instruments(self, proto):
+        ## Report the measurements of the exporter's own work.
+        k = time.time()
+        snapshot = _instruments.snapshot()
+        parts = [ ]
+        for fam in _instruments.schema():
+            render = fam.proto_fragments if proto else fam.fragments
+            texts_for_tup = { tup: [ text ] for tup, text
+                              in render(k, snapshot).items() }
+            parts.append(self.__assemble(fam, texts_for_tup, proto))
+            continue
+        return (b'' if proto else '').join(parts)
+
+    def __columns(self, fi, columns, proto):
+        ## Render the points of a family's series captured from the
+        ## columnar store.
+        fam = self.schema[fi]
+        after, lo, snaps = columns
+        texts_for_tup = { }
+        for cs in snaps[fi]:
+            labels = cs[0]
+            if proto:
+                texts = [ fam.proto_points(labels, pts, k)
+                          for k, pts in _Columns.rows(cs, after, lo) ]
+            else:
+                texts = [ fam.point_text(labels, pts, k)
+                          for k, pts in _Columns.rows(cs, after, lo) ]
+                pass
+            if len(texts) > 0:
+                texts_for_tup[labels] = texts
+                pass
+            continue
+        return self.__assemble(fam, texts_for_tup, proto)
+
+    def __stream(self, snap, overflow, columns, proto):
+        ## Yield any data that has arrived since the client's
+        ## timestamp.  The time spent rendering excludes the time
+        ## spent by the caller between families.
+        elapsed = 0.0
+        for fi in range(len(self.schema)):
+            start = time.perf_counter()
+            if self.store is None:
+                part = self.__family(snap, overflow, fi, proto)
+            elif columns is None:
+                part = self.__assemble(self.schema[fi], { }, proto)
+            else:
+                part = self.__columns(fi, columns, proto)
+                pass
+            elapsed += time.perf_counter() - start
+            yield part
+            continue
+        if self.budgets:
+            yield self.__overflow(snap, overflow, proto)
+            pass
+        self.render_time.observe(elapsed)
+        yield self.__instruments(proto)
 
+        ## Complete the message.  The protobuf format has no
+        ## terminator.
+        if not proto:
+            yield '# EOF\n'
             pass
+        pass
 
-        return (msg, ts, latest)
+    def get_message(self, ident):
+        """Get the latest data for a given client, in OpenMetrics format.
+        See stream_message().  A tuple of the complete message, the
+        client's previous timestamp and its new timestamp is
+        returned.
+
+        """
+        ts, latest, parts = self.stream_message(ident)
+        return (''.join(parts), ts, latest)
 
     def check(self):
         """Check whether this history has been terminated."""
@@ -372,14 +1982,197 @@ class MetricHistory:
             pass
         pass
 
-    def http_handler(self, **kwargs):
-        """Get an HTTP handler that serves this history."""
-        return functools.partial(MetricsHTTPHandler, hist=self, **kwargs)
+    def http_handler(self, prescrape=None, interval=0, **kwargs):
+        """Get an HTTP handler that serves this history.  A 'prescrape'
+        function is wrapped in a Prescraper, with 'interval', unless
+        it is one already.
+
+        """
+        if prescrape is not None and not isinstance(prescrape, Prescraper):
+            prescrape = Prescraper(prescrape, interval)
+            pass
+        return functools.partial(MetricsHTTPHandler, hist=self,
+                                 prescrape=prescrape, **kwargs)
+
+    pass
+
+class Prescraper:
+    """Wraps a function that populates a history with current data
+    before each scrape, so that it runs once for concurrent scrapes,
+    and not again within 'interval' seconds of its last successful
+    run.  A scrape that finds the function already running waits for
+    it to finish, and then serves its results.  Scrapes in between
+    runs serve the previous results.  Their age is reported as
+    gridmon_prescrape_age_seconds.
+
+    """
+
+    def __init__(self, func, interval=0):
+        self.func = func
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.running = False
+        self.runs = 0
+        self.last = None
+        self.age = _instruments.since(
+            'gridmon_prescrape_age',
+            'time since live metrics were last collected for scraping')
+        pass
+
+    def __call__(self):
+        with self.lock:
+            if self.running:
+                ## Share the results of the run in progress.
+                runs = self.runs
+                while self.running and self.runs == runs:
+                    self.idle.wait()
+                    continue
+                return
+            if self.last is not None and \
+               time.monotonic() - self.last < self.interval:
+                return
+            self.running = True
+            pass
+
+        ## Only a successful run counts, so a failure is retried by
+        ## the next scrape.
+        start = time.monotonic()
+        done = False
+        try:
+            self.func()
+            done = True
+        finally:
+            with self.lock:
+                self.running = False
+                self.runs += 1
+                if done:
+                    self.last = start
+                    self.age.mark()
+                    pass
+                self.idle.notify_all()
+                pass
+            pass
+        pass
 
     pass
 
 
+def _gzip_compressor():
+    import zlib
+    return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 31)
+
+def _zstd_compressor():
+    import zstandard
+    return zstandard.ZstdCompressor().compressobj()
+
+def _get_encodings():
+    """Get the content codings that scrape responses can use, as a dict
+    from coding name to a function yielding a new compressor.  The
+    dict is in order of preference.  zstd is only offered if the
+    zstandard module is available.
+
+    """
+    result = { }
+    try:
+        import zstandard
+        result['zstd'] = _zstd_compressor
+    except ImportError:
+        pass
+    result['gzip'] = _gzip_compressor
+    return result
+
+def _choose_encoding(accept, available):
+    """Choose a content coding according to an Accept-Encoding header
+    field.  The name of the coding is returned, or None if the
+    content should not be encoded.  Amongst codings equally
+    acceptable to the client, the first in 'available' is chosen.
+
+    """
+    if accept is None:
+        return None
+    quals = { }
+    for item in accept.split(','):
+        parts = item.split(';')
+        name = parts[0].strip().lower()
+        if len(name) == 0:
+            continue
+        qual = 1.0
+        for param in parts[1:]:
+            pn, _, pv = param.partition('=')
+            if pn.strip().lower() == 'q':
+                try:
+                    qual = float(pv)
+                except ValueError:
+                    qual = 0.0
+                    pass
+                pass
+            continue
+        quals[name] = qual
+        continue
+    best = None
+    bestq = 0.0
+    for name in available:
+        qual = quals.get(name, quals.get('*', 0.0))
+        if qual > bestq:
+            best = name
+            bestq = qual
+            pass
+        continue
+    return best
+
+## The media type of the Prometheus protobuf exposition format
+_proto_type = 'application/vnd.google.protobuf'
+_proto_params = {
+    'proto': 'io.prometheus.client.MetricFamily',
+    'encoding': 'delimited',
+}
+
+def _prefers_protobuf(accept):
+    """Determine whether an Accept header field prefers the delimited
+    protobuf exposition format to any other, which is assumed to be
+    text.  Amongst equally acceptable types, the protobuf format is
+    preferred, as it was explicitly requested.  It is only chosen if
+    the generated module for it is available.
+
+    """
+    if accept is None:
+        return False
+    proto = 0.0
+    other = 0.0
+    for item in accept.split(','):
+        parts = item.split(';')
+        mtype = parts[0].strip().lower()
+        params = { }
+        for param in parts[1:]:
+            pn, _, pv = param.partition('=')
+            params[pn.strip().lower()] = pv.strip().strip('"')
+            continue
+        try:
+            qual = float(params.get('q', 1.0))
+        except ValueError:
+            qual = 0.0
+            pass
+        if mtype != _proto_type:
+            other = max(other, qual)
+        elif all(params.get(pn) == pv for pn, pv in _proto_params.items()):
+            proto = max(proto, qual)
+            pass
+        continue
+    if proto == 0.0 or proto < other:
+        return False
+    try:
+        import lancs_gridmon.metrics.client_model_pb2
+    except ImportError:
+        return False
+    return True
+
 class MetricsHTTPHandler(BaseHTTPRequestHandler):
+    ## Chunked transfer encoding is only available with HTTP/1.1.
+    ## Connections are still closed after each response, so a
+    ## single-threaded server is not held up by idle clients.
+    protocol_version = 'HTTP/1.1'
+
     def __init__(self, *args, hist=None, prescrape=None, prebody=None, **kwargs):
         self.hist = hist
         self.prebody = prebody
@@ -387,6 +2180,25 @@ class MetricsHTTPHandler(BaseHTTPRequestHandler):
         super().__init__(*args, **kwargs)
         pass
 
+    def __write(self, data):
+        ## A zero-length chunk would terminate the body.
+        if len(data) == 0:
+            return
+        if self.chunked:
+            self.wfile.write(b''.join((b'%x\r\n' % len(data), data, b'\r\n')))
+        else:
+            self.wfile.write(data)
+            pass
+        pass
+
+    def __send(self, comp, text):
+        data = text if isinstance(text, bytes) else text.encode('UTF-8')
+        if comp is not None:
+            data = comp.compress(data)
+            pass
+        self.__write(data)
+        pass
+
     def do_GET(self):
         ## Identify the client by the authorization string.
         auth = self.headers.get('Authorization')
@@ -400,24 +2212,61 @@ class MetricsHTTPHandler(BaseHTTPRequestHandler):
             self.prescrape()
             pass
 
-        ## Form the message appropriate to the client, and send it.
+        ## Form the message appropriate to the client, in the
+        ## protobuf format if it prefers that.  Additional content
+        ## can only be provided as text.
+        proto = self.prebody is None and \
+            _prefers_protobuf(self.headers.get('Accept'))
         logging.info('Forming metrics message for %s' % auth)
-        body, ts0, ts1 = self.hist.get_message(auth)
+        ts0, ts1, parts = self.hist.stream_message(auth, proto=proto)
+
+        ## Compress the body if the client accepts it.  The
+        ## compressor is fed each family in turn, so only its window
+        ## is held in memory.
+        encodings = _get_encodings()
+        enc = _choose_encoding(self.headers.get('Accept-Encoding'),
+                               encodings)
+        comp = None if enc is None else encodings[enc]()
+
+        ## Send the headers.  HTTP/1.0 clients get the body delimited
+        ## by closing the connection.
+        self.chunked = self.request_version == 'HTTP/1.1'
+        self.close_connection = True
+        self.send_response(200)
+        if proto:
+            ct = _proto_type + ''.join([ '; %s=%s' % pp
+                                         for pp in _proto_params.items() ])
+        else:
+            ct = 'application/openmetrics-text'
+            ct += '; version=1.0.0; charset=utf-8'
+            pass
+        self.send_header('Content-Type', ct)
+        self.send_header('Vary', 'Accept, Accept-Encoding')
+        if comp is not None:
+            self.send_header('Content-Encoding', enc)
+            pass
+        if self.chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+            pass
+        self.send_header('Connection', 'close')
+        self.end_headers()
 
         ## Prefix the body with additional content, if a provider is
         ## specified.
         if callable(self.prebody):
-            prebody = self.prebody()
-            body = prebody + body
+            self.__send(comp, self.prebody())
             pass
 
-        ## Send the complete response.
-        self.send_response(200)
-        ct = 'application/openmetrics-text'
-        ct += '; version=1.0.0; charset=utf-8'
-        self.send_header('Content-Type', ct)
-        self.end_headers()
-        self.wfile.write(body.encode('UTF-8'))
+        ## Send each family as it is rendered.
+        for part in parts:
+            self.__send(comp, part)
+            continue
+        if comp is not None:
+            self.__write(comp.flush())
+            pass
+        if self.chunked:
+            self.wfile.write(b'0\r\n\r\n')
+            pass
         logging.info('Completed metrics %d-%d' % (ts1, ts1 - ts0))
         pass
 
@@ -425,14 +2274,380 @@ class MetricsHTTPHandler(BaseHTTPRequestHandler):
 
 ## Remote-write specification?: <https://docs.google.com/document/d/1LPhVRSFkGNSuU1fBd81ulhsCPR4hkSZyyBj1SZ8fWOM/edit#>
 
-## Snappy: <http://google.github.io/snappy/>
+## Snappy: <http://google.github.io/snappy/>
+
+def _backoff(attempt, initial, deadline, limit=360):
+    """Choose how long to wait before retrying a request.  The delay
+    grows exponentially from 'initial' seconds with each attempt, up
+    to 'limit', and is jittered so that several writers do not retry
+    in step.  None is returned if the retry could not complete before
+    'deadline'.
+
+    """
+    import random
+    delay = random.uniform(0.5, 1.0) * min(limit, initial * 2 ** attempt)
+    delay = min(delay, deadline - time.time() - 1)
+    return None if delay < 1 else delay
+
+def _ordered_samples(seq):
+    ## Sort (timestamp, value) pairs by time, keeping only the last of
+    ## any with the same time.
+    seq.sort(key=lambda p: p[0])
+    res = [ seq[0] ]
+    for p in seq[1:]:
+        if p[0] == res[-1][0]:
+            res[-1] = p
+        else:
+            res.append(p)
+            pass
+        continue
+    return res
+
+## Metric types as enumerated by version 2.0 of the remote-write
+## protocol
+_rw2_types = {
+    'counter': 1,
+    'gauge': 2,
+    'histogram': 3,
+    'gaugehistogram': 4,
+    'summary': 5,
+    'info': 6,
+    'stateset': 7,
+}
+
+def _rw_histogram(msg, value, stamp, gauge):
+    ## Fill in a remote-write Histogram message (of either protocol
+    ## version) from a native histogram at a time in seconds.
+    msg.count_int = value.count
+    msg.sum = value.sum
+    msg.schema = value.schema
+    msg.zero_threshold = value.zero_threshold
+    msg.zero_count_int = value.zero_count
+    for buckets, spans, deltas in \
+        ((value.positive, msg.positive_spans, msg.positive_deltas),
+         (value.negative, msg.negative_spans, msg.negative_deltas)):
+        sps, dts = value.spans(buckets)
+        for offset, length in sps:
+            sp = spans.add()
+            sp.offset = offset
+            sp.length = length
+            continue
+        deltas.extend(dts)
+        continue
+    if gauge:
+        msg.reset_hint = msg.GAUGE
+        pass
+    msg.timestamp = int(stamp * 1000)
+    pass
+
+def _shard_series(series, limit):
+    ## Split a dict of series into dicts of at most 'limit' samples
+    ## each, unless a single series has more.
+    shards = [ ]
+    shard = { }
+    count = 0
+    for key, vals in series.items():
+        if count > 0 and count + len(vals) > limit:
+            shards.append(shard)
+            shard = { }
+            count = 0
+            pass
+        shard[key] = vals
+        count += len(vals)
+        continue
+    if count > 0:
+        shards.append(shard)
+        pass
+    return shards
+
+def _renamed(key, name):
+    ## Get a series key with a different name.
+    from frozendict import frozendict
+    res = dict(key)
+    res['__name__'] = name
+    return frozendict(sorted(res.items()))
+
+class _Rollup:
+    """Reduces series to one sample per window of time, as series
+    keyed by frozen label dicts pass from installation to sending.
+    Samples of gauges are reduced to their average, under the original
+    name, and their minimum and maximum, as _min and _max.  Other
+    samples (including the buckets, counts and sums of histograms)
+    are reduced to their last value, so counters keep their meaning.
+    Each window is released, with the timestamp of each series' last
+    sample, once a sample 'grace' seconds (one window by default)
+    after its end has been seen, so that slower sources can catch
+    up.  Samples arriving for a window already released are dropped,
+    and counted as late.
+
+    If 'aggregate' names some labels, series are also summed over
+    those labels, and the sums are sent too, without them.  Each
+    sum includes the latest value of each contributing series seen
+    within 'timeout' seconds, except that the earliest _created
+    value, the least _min and the greatest _max are taken instead.
+
+    """
+
+    def __init__(self, families, window, aggregate=(), timeout=5*60,
+                 grace=None):
+        self.families = families
+        self.window = window
+        self.aggregate = frozenset(aggregate)
+        self.timeout = timeout
+        self.grace = window if grace is None else grace
+        self.gauges = { }
+        self.open = { }
+        self.latest = None
+        self.released = None
+        self.late = 0
+        self.members = { }
+        self.reducers = { }
+        pass
+
+    def __is_gauge(self, name):
+        res = self.gauges.get(name)
+        if res is None:
+            family = self.families.get(name)
+            res = self.gauges[name] = \
+                family is not None and family.type == 'gauge'
+            pass
+        return res
+
+    def apply(self, series):
+        """Accumulate series, and return those of the windows that have
+        ended.
+
+        """
+        for key, vals in series.items():
+            gauge = self.__is_gauge(key['__name__'])
+            for ts, val in vals:
+                w = int(ts // self.window)
+                if self.released is not None and w <= self.released:
+                    ## The window has already been sent.
+                    self.late += 1
+                    continue
+                wk = (key, w)
+                st = self.open.get(wk)
+                if st is None:
+                    self.open[wk] = [ ts, val, val, val, val, 1 ] \
+                        if gauge and val is not None else [ ts, val ]
+                else:
+                    if ts >= st[0]:
+                        st[0] = ts
+                        st[1] = val
+                        pass
+                    if len(st) > 2 and val is not None:
+                        st[2] = min(st[2], val)
+                        st[3] = max(st[3], val)
+                        st[4] += val
+                        st[5] += 1
+                        pass
+                    pass
+                if self.latest is None or ts > self.latest:
+                    self.latest = ts
+                    pass
+                continue
+            continue
+        if self.latest is None:
+            return { }
+        current = int((self.latest - self.grace) // self.window)
+        return self.__release([ wk for wk in self.open if wk[1] < current ])
+
+    def drain(self):
+        """Return the series of all windows, ended or not."""
+        return self.__release(list(self.open))
+
+    def __release(self, ended):
+        res = { }
+        reducers = { }
+        for wk in sorted(ended, key=lambda wk: wk[1]):
+            key = wk[0]
+            st = self.open.pop(wk)
+            if self.released is None or wk[1] > self.released:
+                self.released = wk[1]
+                pass
+            if len(st) == 2:
+                res.setdefault(key, [ ]).append((st[0], st[1]))
+                continue
+            name = key['__name__']
+            res.setdefault(key, [ ]).append((st[0], st[4] / st[5]))
+            for sfx, val, op in (('_min', st[2], min), ('_max', st[3], max)):
+                rkey = _renamed(key, name + sfx)
+                res.setdefault(rkey, [ ]).append((st[0], val))
+                reducers[rkey] = op
+                continue
+            continue
+        if self.aggregate:
+            res.update(self.__sums(res, reducers))
+            pass
+        return res
+
+    def __sums(self, released, reducers):
+        ## Record the latest value of each series with an aggregated
+        ## label, and sum those sharing their other labels.  The
+        ## minima and maxima of gauges are combined as such.
+        from frozendict import frozendict
+        touched = set()
+        for key, vals in released.items():
+            if not any(ln in self.aggregate for ln in key):
+                continue
+            akey = frozendict((ln, lv) for ln, lv in key.items()
+                              if ln not in self.aggregate)
+            self.members.setdefault(akey, { })[key] = vals[-1]
+            if key in reducers:
+                self.reducers[akey] = reducers[key]
+                pass
+            touched.add(akey)
+            continue
+        res = { }
+        for akey in touched:
+            members = self.members[akey]
+            latest = max(ts for ts, _ in members.values())
+            threshold = latest - self.timeout
+            for key in [ key for key, last in members.items()
+                         if last[0] < threshold ]:
+                del members[key]
+                continue
+            if akey['__name__'].endswith('_created'):
+                op = min
+            else:
+                op = self.reducers.get(akey, operator.add)
+                pass
+            total = None
+            for ts, val in members.values():
+                if val is None:
+                    continue
+                total = val if total is None else op(total, val)
+                continue
+            if total is not None:
+                res[akey] = [ (latest, total) ]
+                pass
+            continue
+        return res
+
+    pass
+
+class RemoteMetricsWriter:
+    def __init__(self, endpoint, schema, expiry=5*60, labels=dict(),
+                 asynchronous=False, queue_limit=64,
+                 log=None, log_limit=64*1024*1024, log_age=60*60,
+                 connection_limit=2, flush_interval=0, flush_samples=10000,
+                 shard_samples=2000, shard_workers=2, protocol='1.0',
+                 label_cache_size=200000, budgets=None, keepalive=None,
+                 rollup=None, **kwargs):
+        self.expiry = expiry
+        self.endpoint = endpoint
+
+        ## Writers to the same endpoint share a pool of keep-alive
+        ## connections.  The connection limit only applies if this
+        ## is the first writer to the endpoint.
+        if endpoint is not None:
+            from lancs_gridmon.httppool import get_pool, request_target
+            self.pool = get_pool(endpoint, limit=connection_limit)
+            self.target = request_target(endpoint)
+            pass
+        self.schema = compile_schema(schema)
+        self.labels = labels
+
+        ## Version 2.0 of the protocol puts all strings in a symbol
+        ## table, and carries metadata, so each sample name must be
+        ## mapped back to its family.
+        if protocol not in ('1.0', '2.0'):
+            raise ValueError('unsupported remote-write protocol %s' %
+                             protocol)
+        self.protocol = protocol
+
+        ## Sample keys are cached per family and series labels, so
+        ## that a repeated push needn't rebuild them.  The label
+        ## functions are still evaluated for every series, as labels
+        ## may depend on the snapshot; only building the frozen keys
+        ## is saved.  The least recently used entries are evicted
+        ## first.  The cache, like the budgets, roll-up and keepalive
+        ## state, is only touched while converting data, which is
+        ## done by one thread at a time.
+        self.label_cache = collections.OrderedDict()
+        self.label_cache_size = label_cache_size
+        self.convert_lock = threading.Lock()
+
+        ## If 'keepalive' is set, the last value and time sent for
+        ## each series are kept, and a sample with the same value is
+        ## skipped, unless 'keepalive' seconds have passed since.
+        ## They are recorded only once a request has been delivered.
+        ## Entries that can no longer suppress a sample are swept
+        ## away once per interval.
+        self.keepalive = keepalive
+        self.last_sent = { } if keepalive is not None else None
+        self.last_sweep = None
+
+        ## Some families may have a limited number of series, as
+        ## described by MetricHistory.  The number beyond each limit
+        ## is sent as gridmon_series_overflow.
+        self.budgets = _series_budgets(self.schema, budgets)
+
+        if 'job' in kwargs:
+            self.job = kwargs['job']
+            pass
+
+        ## The writer's own work is measured.  The measurements are
+        ## served by any MetricHistory in the process, and also sent
+        ## with the writer's data, at most once a minute.
+        ident = { 'writer': getattr(self, 'job', endpoint) or 'stdout' }
+        self.serialise_time = _instruments.histogram(
+            'gridmon_remote_write_serialise', 'seconds',
+            'time building and serializing remote-write requests',
+            _time_bounds, ident)
+        self.compress_time = _instruments.histogram(
+            'gridmon_remote_write_compress', 'seconds',
+            'time compressing remote-write requests', _time_bounds, ident)
+        self.post_time = _instruments.histogram(
+            'gridmon_remote_write_post', 'seconds',
+            'time taken by each remote-write request attempt',
+            _time_bounds, ident)
+        self.payload_size = _instruments.histogram(
+            'gridmon_remote_write_payload', 'bytes',
+            'size of compressed remote-write requests', _size_bounds, ident)
+        self.retry_count = _instruments.counter(
+            'gridmon_remote_write_retries',
+            'remote-write request attempts repeated', ident)
+        self.instruments = [ self.serialise_time, self.compress_time,
+                             self.post_time, self.payload_size,
+                             self.retry_count ]
+        self.instrument_schema = _instruments.schema([
+            'gridmon_remote_write_serialise',
+            'gridmon_remote_write_compress',
+            'gridmon_remote_write_post',
+            'gridmon_remote_write_payload',
+            'gridmon_remote_write_retries',
+        ])
+        self.instrument_time = None
+
+        self.families = dict()
+        for family in self.schema + self.instrument_schema + \
+            ([ _overflow_family ] if self.budgets else [ ]):
+            for name in family.point_names():
+                self.families[name] = family
+                continue
+            continue
+
+        ## If 'rollup' is set, series are reduced to one sample per
+        ## window before sending.  It gives the window in seconds, or
+        ## is a dict with 'window', and optionally 'aggregate' as a
+        ## list of label names to sum over, 'timeout' and 'grace' (see
+        ## _Rollup).  Gauges acquire _min and _max samples.
+        self.rollup = None
+        if rollup is not None:
+            if not isinstance(rollup, dict):
+                rollup = { 'window': rollup }
+                pass
+            self.rollup = _Rollup(self.families, **rollup)
+            for name, family in list(self.families.items()):
+                if family.type == 'gauge':
+                    self.families[name + '_min'] = family
+                    self.families[name + '_max'] = family
+                    pass
+                continue
+            pass
 
-class RemoteMetricsWriter:
-    def __init__(self, endpoint, schema, expiry=5*60, labels=dict(), **kwargs):
-        self.expiry = expiry
-        self.endpoint = endpoint
-        self.schema = schema
-        self.labels = labels
         ## Each schema entry describes a metric family, and is a dict
         ## with the following members:
         ##
@@ -458,25 +2673,434 @@ class RemoteMetricsWriter:
         ## tuple.  The function takes a series index (as returned by
         ## 'select') and a snapshot, and yields a label value to be
         ## formatted by the format string.
-
-        if 'job' in kwargs:
-            self.job = kwargs['job']
+        ##
+        ## The schema may already have been prepared with
+        ## compile_schema(), and shared with a MetricHistory.
+
+        ## If asynchronous, installed data is queued, and a separate
+        ## thread converts and sends it.  The caller must not modify
+        ## the data after installing it.  When the queue is full, the
+        ## oldest data is dropped.  Queued data is merged into a
+        ## single request once the oldest has waited 'flush_interval'
+        ## seconds, or 'flush_samples' samples have been gathered.
+        self.queue_limit = queue_limit
+        self.flush_interval = flush_interval
+        self.flush_samples = flush_samples
+
+        ## Requests are split into shards of about 'shard_samples'
+        ## samples, without splitting series, and sent over up to
+        ## 'shard_workers' threads.  Logged shards are sent in order.
+        self.shard_samples = shard_samples
+        self.shard_workers = shard_workers
+        self.executor = None
+
+        ## Optionally, encoded requests are kept in a log on disc (a
+        ## directory) until sent, so they survive a restart, and are
+        ## retried until they are older than 'log_age' seconds.  If
+        ## the log exceeds 'log_limit' bytes, the oldest requests are
+        ## dropped.  Each element's header is the time of its latest
+        ## sample in milliseconds.  Only the sender thread uses the
+        ## log, which implies asynchronous operation.
+        self.log = None
+        if log is not None and endpoint is not None:
+            from lancs_gridmon.queues import PersistentQueue
+            self.log = PersistentQueue(log, ram_size=0, name='remote-write')
+            self.log_limit = log_limit
+            self.log_age = log_age
+
+            ## The last samples of each logged request are kept in
+            ## step with the log, to be recorded when it is sent.
+            ## Requests logged before a restart have none.
+            self.log_sent = collections.deque([ None ] * self.__log_count())
+            asynchronous = True
+            pass
+        self.asynchronous = asynchronous
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.queue = collections.deque()
+        self.busy = False
+        self.closing = False
+        self.halted = threading.Event()
+        self.counters = {
+            'queued': 0,
+            'dropped': 0,
+            'sent': 0,
+            'failed': 0,
+            'retries': 0,
+            'unchanged': 0,
+        }
+        self.sender = None
+        if asynchronous:
+            runner = self.__run if self.log is None else self.__run_logged
+            self.sender = threading.Thread(target=runner, daemon=True,
+                                           name='remote-writer')
+            self.sender.start()
             pass
-
         pass
 
     def check(self):
         return True
 
-    def install(self, data, mismatch=0):
-        from frozendict import frozendict
+    def stats(self):
+        """Get counts of installations queued, dropped from the queue,
+        sent, and failed, retries attempted, samples skipped as
+        unchanged, and the current length of the queue.  If a log is
+        in use, the number of requests in it is also given.  If
+        series are rolled up, the number of samples dropped for
+        arriving after their windows were sent is given as 'late'.
+
+        """
+        with self.lock:
+            res = dict(self.counters)
+            res['pending'] = len(self.queue)
+            pass
+        if self.rollup is not None:
+            res['late'] = self.rollup.late
+            pass
+        if self.log is not None:
+            res['logged'] = self.__log_count()
+            pass
+        return res
 
+    def install(self, data, mismatch=0):
         ## Data is a dict with timestamps (in seconds) as keys.
         ## Values are a usually a dict hierarchy specified by the
         ## schema.  Each of these is referred to as a snapshot below.
         if len(data) == 0:
             return True
 
+        if not self.asynchronous:
+            return self.__deliver(data)
+
+        with self.cond:
+            if self.closing:
+                return False
+
+            ## Make room by discarding the oldest data.
+            if len(self.queue) >= self.queue_limit:
+                self.queue.popleft()
+                self.counters['dropped'] += 1
+                logging.warning('target %s queue full; dropped oldest' %
+                                self.endpoint)
+                pass
+            self.queue.append((time.time(), data))
+            self.counters['queued'] += 1
+            self.cond.notify_all()
+            pass
+        return True
+
+    def encode(self, data):
+        """Convert data into the compressed request bodies that would
+        be sent, one per shard, without sending them.  This is mainly
+        for measuring performance.
+
+        """
+        res = [ ]
+        for shard in _shard_series(self.__series(data), self.shard_samples):
+            req = self.__encode(shard)
+            if req is not None:
+                res.append(req[1])
+                pass
+            continue
+        return res
+
+    def flush(self, timeout=None):
+        """Wait until all queued and logged data has been sent or
+        abandoned.  False is returned if the timeout expired first.
+
+        """
+        with self.cond:
+            return self.cond.wait_for(lambda: len(self.queue) == 0 and \
+                                      not self.busy, timeout)
+        pass
+
+    def close(self, timeout=None):
+        """Stop accepting data, and wait for the queue to be sent.  If it
+        has not been sent within the timeout, further retries are
+        abandoned, and any remaining data is dropped, or kept in the
+        log for next time.
+
+        """
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+            pass
+        if self.sender is None:
+            if self.rollup is not None:
+                with self.convert_lock:
+                    rest = self.rollup.drain()
+                    pass
+                self.__send(rest)
+                pass
+            return
+        self.sender.join(timeout)
+        if self.sender.is_alive():
+            with self.cond:
+                self.halted.set()
+                self.cond.notify_all()
+                pass
+            self.sender.join()
+            pass
+
+        ## The log's lock belongs to this thread, so it can't be
+        ## closed by the sender.
+        if self.log is not None:
+            self.log.close()
+            pass
+        if self.executor is not None:
+            self.executor.shutdown()
+            pass
+        pass
+
+    def __log_count(self):
+        st = self.log.stats()
+        return st['mem_count'] + st['disk_count']
+
+    def __spool(self):
+        ## Encode queued data that is ready into the log.
+        while True:
+            series = self.__gather(block=False)
+            if series is None:
+                return
+            self.__log_push(series)
+            continue
+        pass
+
+    def __log_push(self, series):
+        ## Encode series into the log, one request per shard,
+        ## discarding the oldest requests if it grows too big.
+        for shard in _shard_series(series, self.shard_samples):
+            try:
+                req = self.__encode(shard)
+            except Exception:
+                logging.error(traceback.format_exc())
+                with self.lock:
+                    self.counters['failed'] += 1
+                    pass
+                continue
+            if req is None:
+                continue
+            stamp, body = req
+            self.log.push(int(stamp * 1000).to_bytes(8, byteorder='big'),
+                          body)
+            self.log_sent.append(self.__last_samples(shard))
+            continue
+        while True:
+            st = self.log.stats()
+            if st['mem_count'] + st['disk_count'] <= 1 or \
+               st['mem_size'] + st['disc_size'] <= self.log_limit:
+                break
+            self.log.pop()
+            self.log_sent.popleft()
+            with self.lock:
+                self.counters['dropped'] += 1
+                pass
+            logging.warning('target %s log full; dropped oldest' %
+                            self.endpoint)
+            continue
+        pass
+
+    def __run_logged(self):
+        try:
+            while True:
+                self.__spool()
+                with self.cond:
+                    idle = self.__log_count() == 0
+                    if idle:
+                        self.busy = False
+                        self.cond.notify_all()
+                        pass
+                    pass
+
+                ## With nothing to send, wait for more data.
+                if idle:
+                    series = self.__gather(block=True)
+                    if series is None:
+                        return
+                    self.__log_push(series)
+                    continue
+
+                with self.cond:
+                    if self.halted.is_set():
+                        return
+                    self.busy = True
+                    pass
+
+                ## Requests are sent in order, and the oldest is
+                ## retried until it is too old, so later ones wait
+                ## behind it.
+                header, body = self.log.pop()
+                sent = self.log_sent.popleft()
+                stamp = int.from_bytes(header, byteorder='big') / 1000
+                deadline = stamp + self.log_age
+                if deadline < time.time():
+                    with self.lock:
+                        self.counters['dropped'] += 1
+                        pass
+                    logging.warning('target %s request too old; dropped' %
+                                    self.endpoint)
+                    continue
+                okay = self.__post(body, deadline)
+                if okay is None:
+                    self.log.restore(header, body)
+                    self.log_sent.appendleft(sent)
+                    return
+                if okay:
+                    self.__record_sent(sent)
+                    pass
+                with self.lock:
+                    self.counters['sent' if okay else 'failed'] += 1
+                    pass
+                continue
+        except Exception:
+            logging.error(traceback.format_exc())
+        finally:
+            ## Anything not yet sent is saved for next time.
+            self.__spool()
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
+                pass
+            pass
+        pass
+
+    def __pause(self, delay):
+        ## Wait before retrying, but keep moving new data into the
+        ## log.  True is returned if the writer has been halted.
+        limit = time.time() + delay
+        while not self.halted.is_set():
+            if self.log is not None:
+                self.__spool()
+                pass
+            rem = limit - time.time()
+            if rem <= 0:
+                return False
+            with self.cond:
+                self.cond.wait_for(self.halted.is_set, rem)
+                pass
+            continue
+        return True
+
+    def __run(self):
+        while True:
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
+                pass
+            series = self.__gather(block=True)
+            if series is None:
+                return
+            try:
+                self.__send(series)
+            except Exception:
+                logging.error(traceback.format_exc())
+                pass
+            continue
+        pass
+
+    def __gather(self, block):
+        ## Take queued data, and convert it into a merged set of
+        ## series.  Data is taken once the oldest has waited for the
+        ## flush interval, or the writer is closing, and then until
+        ## the queue is empty or enough samples have been gathered.
+        ## If blocking, wait for data, and for more data until the
+        ## interval has passed.  None is returned if there's nothing
+        ## (ready) to take.
+        with self.cond:
+            if block:
+                self.cond.wait_for(lambda: len(self.queue) > 0 or
+                                   self.closing)
+                pass
+            drain = len(self.queue) == 0
+            if drain:
+                ## Windows still open when the writer closes are sent
+                ## last.
+                if not self.closing or self.rollup is None or \
+                   len(self.rollup.open) == 0:
+                    return None
+                pass
+            elif self.halted.is_set() and self.log is None:
+                self.counters['dropped'] += len(self.queue)
+                self.queue.clear()
+                return None
+            else:
+                deadline = self.queue[0][0] + self.flush_interval
+                if not block and not self.closing and \
+                   deadline > time.time():
+                    return None
+                pass
+            self.busy = True
+            pass
+        if drain:
+            with self.convert_lock:
+                return self.rollup.drain()
+            pass
+
+        series = { }
+        mixed = set()
+        count = 0
+        while count < self.flush_samples:
+            with self.cond:
+                if block:
+                    self.cond.wait_for(lambda: len(self.queue) > 0 or
+                                       self.closing,
+                                       deadline - time.time())
+                    pass
+                if len(self.queue) == 0:
+                    break
+                _, data = self.queue.popleft()
+                pass
+            try:
+                more = self.__series(data)
+            except Exception:
+                logging.error(traceback.format_exc())
+                with self.lock:
+                    self.counters['failed'] += 1
+                    pass
+                continue
+
+            ## Keep track of series that have samples from more than
+            ## one installation, as they must be put in order.
+            for key, vals in more.items():
+                count += len(vals)
+                seq = series.get(key)
+                if seq is None:
+                    series[key] = vals
+                    continue
+                seq.extend(vals)
+                mixed.add(key)
+                continue
+            continue
+        ## Windows still open when the writer closes are sent with the
+        ## last data.
+        with self.cond:
+            final = self.closing and len(self.queue) == 0
+            pass
+        if final and self.rollup is not None:
+            with self.convert_lock:
+                rest = self.rollup.drain()
+                pass
+            for key, vals in rest.items():
+                seq = series.get(key)
+                if seq is None:
+                    series[key] = vals
+                    continue
+                seq.extend(vals)
+                mixed.add(key)
+                continue
+            pass
+        for key in mixed:
+            series[key] = _ordered_samples(series[key])
+            continue
+        return series
+
+    def __series(self, data):
+        ## Convert data into series.  Synchronous writers may be
+        ## given data by several threads at once.
+        with self.convert_lock:
+            return self.__convert(data)
+
+    def __convert(self, data):
         ## Get all the timestamps in order.
         tss = [ ts for ts in data ]
         tss.sort()
@@ -485,107 +3109,300 @@ class RemoteMetricsWriter:
         ## timestamps to sample values.
         series = { }
 
-        ## Consider each metric family.
-        lasttime = 0
-        for family in self.schema:
-            basename = family['base']
-            unit = family.get('unit')
-            sel = family['select']
-            lab = family['attrs']
-            sam = family['samples']
-            typ = family.get('type')
-            gcount_name = 'gcount' if typ == 'gaugehistogram' else 'count'
-            gsum_name = 'gsum' if typ == 'gaugehistogram' else 'sum'
-
-            if unit is not None:
-                basename += '_' + unit
-                pass
+        ## Get the labels shared by all series.
+        common = { }
+        if hasattr(self, 'job'):
+            common['job'] = self.job
+            pass
+        common.update(self.labels)
 
+        ## Consider each metric family.  Count the series beyond
+        ## each budget.
+        overflow = { ts: { } for ts in tss }
+        for fi, family in enumerate(self.schema):
+            budget = self.budgets.get(fi)
             for ts in tss:
                 snapshot = data[ts]
-
-                for idx in sel(snapshot):
-                    ## Get the labels shared by all samples in the
-                    ## family.
-                    famkey = { }
-                    if hasattr(self, 'job'):
-                        famkey['job'] = self.job
+                items = family.series(snapshot)
+                if budget is not None:
+                    items = list(items)
+                    over = budget.partition([ idx for idx, _ in items ], ts)
+                    overflow[ts][family.base] = len(over)
+                    if len(over) > 0:
+                        excess = [ it for it in items if it[0] in over ]
+                        items = [ it for it in items if it[0] not in over ]
                         pass
-                    famkey.update(self.labels)
-                    for labname, labspec in lab.items():
-                        if labspec is callable:
-                            for labsfx, labval in labspec(idx, snapshot).items():
-                                if labval is not None:
-                                    famkey[labname + labsfx] = labval
-                                    pass
-                                continue
+                    if len(over) > 0 and budget.fold:
+                        for labels, points in \
+                            family.fold(excess, snapshot, budget.fold).items():
+                            self.__add_folded(series, common, labels,
+                                              points, ts)
                             continue
+                        pass
+                    pass
+                self.__add_series(series, common, fi, family, ts, snapshot,
+                                  items)
+                continue
+            continue
 
-                        labspec = _get_sample_func(labspec)
-                        labval = _safe_mod(labspec, idx, snapshot)
-                        if labval is not None:
-                            famkey[labname] = labval
-                            pass
-                        continue
+        if self.budgets:
+            for ts in tss:
+                self.__add_series(series, common, None, _overflow_family, ts,
+                                  overflow[ts],
+                                  _overflow_family.series(overflow[ts]))
+                continue
+            pass
 
-                    for sfx, xxx in sam.items():
-                        samfmt, samfunc = _get_sample_func(xxx)
-                        ## The sample key is the family key plus a
-                        ## __name__ label.  Then freeze it so it can
-                        ## be used as a dict key.
-                        samkey = dict(famkey)
-                        samkey['__name__'] = basename + sfx
-                        samkey = frozendict(samkey)
-
-                        ## Extract the value.
-                        val = _safe_func(samfunc)(idx, snapshot)
-
-                        if callable(samfmt):
-                            ## Convert the value using the function.
-                            val = samfmt(val)
-
-                            def insert(sfx, value, *args):
-                                subkey = dict(samkey)
-                                subkey['__name__'] += sfx
-                                for k, v in args:
-                                    subkey[k] = v
-                                subkey = frozendict(subkey)
-                                seq = series.setdefault(subkey, [ ])
-                                seq.append((ts, value))
-                                pass
-                            for thr, thrv in val.items():
-                                if isinstance(thr, (int, float)):
-                                    sublab = ('le', '%g' % thr)
-                                    insert('_bucket', thrv, sublab)
-                                    pass
-                                continue
-                            ## The +inf bucket and the count are the same.
-                            insert('_bucket', val['count'], ('le', '+inf'))
-                            insert('_' + gcount_name, val['count'])
-                            insert('_' + gsum_name, val['sum'])
-                        else:
-                            ## Append the timestamp and value to the
-                            ## series as a tuple.  Because we already
-                            ## sorted the timestamps, each time series's
-                            ## values will always be added in order.
-                            seq = series.setdefault(samkey, [ ])
-                            seq.append((ts, val))
-                            pass
-                        if ts > lasttime:
-                            lasttime = ts
-                            pass
-                        continue
+        if self.rollup is not None:
+            series = self.rollup.apply(series)
+            pass
+
+        if self.last_sent is not None and len(tss) > 0:
+            series = self.__skip_unchanged(series, tss[-1])
+            pass
+
+        ## Include measurements of the writer's own work, if they
+        ## haven't been sent for a while.  They are stamped with the
+        ## current time, so they are kept out of roll-up windows and
+        ## keepalive suppression.
+        now = time.time()
+        if self.instrument_time is None or now >= self.instrument_time + 60:
+            self.instrument_time = now
+            snapshot = _instruments.snapshot(self.instruments)
+            for family in self.instrument_schema:
+                self.__add_series(series, common, family.base, family, now,
+                                  snapshot, family.series(snapshot))
+                continue
+            pass
+        return series
+
+    def __skip_unchanged(self, series, latest):
+        ## Remove samples whose values are the same as those last
+        ## sent, unless the keepalive interval has passed.  Series
+        ## left with no samples are removed.
+        last_sent = self.last_sent
+        skipped = 0
+        res = { }
+        for key, vals in series.items():
+            last = last_sent.get(key)
+            kept = [ ]
+            for ts, val in vals:
+                if last is not None and val == last[1] and \
+                   last[0] <= ts < last[0] + self.keepalive:
+                    skipped += 1
                     continue
+                kept.append((ts, val))
+                if last is None or ts >= last[0]:
+                    last = (ts, val)
+                    pass
                 continue
+            if len(kept) > 0:
+                res[key] = kept
+                pass
             continue
 
-        ## Do nothing on empty data.
-        if len(series) == 0:
+        ## Forget series whose last samples were sent too long ago to
+        ## suppress anything.
+        if self.last_sweep is None or \
+           latest >= self.last_sweep + self.keepalive:
+            threshold = latest - self.keepalive
+            with self.lock:
+                self.last_sent = { key: last for key, last
+                                   in self.last_sent.items()
+                                   if last[0] >= threshold }
+                pass
+            self.last_sweep = latest
+            pass
+
+        if skipped > 0:
+            with self.lock:
+                self.counters['unchanged'] += skipped
+                pass
+            pass
+        return res
+
+    def __last_samples(self, series):
+        ## Get the last sample of each series about to be sent, if
+        ## they are to be recorded once it has been.
+        if self.last_sent is None:
+            return None
+        return { key: vals[-1] for key, vals in series.items() }
+
+    def __record_sent(self, sent):
+        ## Record the last samples of each series just delivered, so
+        ## that unchanged values can be skipped later.
+        if sent is None:
+            return
+        with self.lock:
+            for key, last in sent.items():
+                prev = self.last_sent.get(key)
+                if prev is None or last[0] >= prev[0]:
+                    self.last_sent[key] = last
+                    pass
+                continue
+            pass
+        pass
+
+    def __add_series(self, series, common, fi, family, ts, snapshot, items):
+        ## Append the samples of a family's series at one timestamp.
+        ## 'items' yields (index, node) pairs.
+        from frozendict import frozendict
+        cache = self.label_cache
+        for idx, node in items:
+            labels = family.labels(idx, snapshot)
+
+            ## Get the sample keys already made for a series of this
+            ## family with the same labels.
+            keys = None
+            if self.label_cache_size > 0:
+                ck = (fi, tuple(labels))
+                try:
+                    keys = cache.get(ck)
+                except TypeError:
+                    ## A label value is not hashable.
+                    ck = None
+                    pass
+                if keys is not None:
+                    cache.move_to_end(ck)
+                elif ck is not None:
+                    keys = cache[ck] = dict()
+                    if len(cache) > self.label_cache_size:
+                        cache.popitem(last=False)
+                        pass
+                    pass
+                pass
+
+            famkey = None
+            for name, extra, val in family.points(idx, snapshot, node):
+                samkey = None if keys is None else keys.get((name, extra))
+                if samkey is None:
+                    ## Get the labels shared by all samples in the
+                    ## family.
+                    if famkey is None:
+                        famkey = dict(common)
+                        famkey.update(labels)
+                        pass
+
+                    ## The sample key is the family key plus a __name__
+                    ## label.  Then freeze it so it can be used as a
+                    ## dict key, with the labels in name order, so that
+                    ## encoders needn't sort them.
+                    samkey = dict(famkey)
+                    samkey['__name__'] = name
+                    samkey.update(extra)
+                    samkey = frozendict(sorted(samkey.items()))
+                    if keys is not None:
+                        keys[(name, extra)] = samkey
+                        pass
+                    pass
+
+                ## Append the timestamp and value to the series as a
+                ## tuple.  Because the timestamps are taken in order,
+                ## each time series's values will always be added in
+                ## order.
+                seq = series.setdefault(samkey, [ ])
+                seq.append((ts, val))
+                continue
+            continue
+        pass
+
+    def __add_folded(self, series, common, labels, points, ts):
+        ## Append the samples of a series folded by a budget.
+        from frozendict import frozendict
+        famkey = dict(common)
+        famkey.update(labels)
+        for name, extra, val in points:
+            samkey = dict(famkey)
+            samkey['__name__'] = name
+            samkey.update(extra)
+            samkey = frozendict(sorted(samkey.items()))
+            series.setdefault(samkey, [ ]).append((ts, val))
+            continue
+        pass
+
+    def __deliver(self, data):
+        return self.__send(self.__series(data))
+
+    def __send(self, series):
+        ## Split the series into shards, and send them concurrently
+        ## if there are several.  Success requires all shards to be
+        ## sent.
+        shards = _shard_series(series, self.shard_samples)
+        if len(shards) <= 1 or self.endpoint is None:
+            return all([ self.__send_shard(shard) for shard in shards ])
+        with self.lock:
+            if self.executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self.executor = \
+                    ThreadPoolExecutor(max_workers=self.shard_workers,
+                                       thread_name_prefix='remote-shard')
+                pass
+            pass
+        results = list(self.executor.map(self.__send_shard, shards))
+        okay = sum(1 for r in results if r)
+        if okay < len(results):
+            logging.error('target %s %d of %d shards failed' %
+                          (self.endpoint, len(results) - okay, len(results)))
+            pass
+        return okay == len(results)
+
+    def __send_shard(self, series):
+        try:
+            req = self.__encode(series)
+        except Exception:
+            logging.error(traceback.format_exc())
+            with self.lock:
+                self.counters['failed'] += 1
+                pass
+            return False
+        if req is None:
+            ## The series were printed instead, or there were none.
+            self.__record_sent(self.__last_samples(series))
             return True
+        stamp, body = req
 
         ## Retries are pointless after this time.
-        expiry = self.expiry + lasttime
+        okay = self.__post(body, stamp + self.expiry)
+        if okay:
+            self.__record_sent(self.__last_samples(series))
+            pass
+        with self.lock:
+            self.counters['sent' if okay else 'failed'] += 1
+            pass
+        return bool(okay)
+
+    def __encode(self, series):
+        ## Get the time of the latest sample, and the compressed
+        ## request body.  None is returned if there is nothing to
+        ## send.
+
+        ## Do nothing on empty data.
+        if len(series) == 0:
+            return None
+
+        start = time.perf_counter()
+        if self.protocol == '2.0':
+            rw = self.__request_v2(series)
+        else:
+            rw = self.__request_v1(series)
+            pass
+
+        if self.endpoint is None:
+            print(rw)
+            return None
+        data = rw.SerializeToString()
+        mid = time.perf_counter()
 
+        ## Compress using Snappy block format.
+        import snappy
+        latest = max(vals[-1][0] for vals in series.values())
+        body = snappy.compress(data)
+        self.serialise_time.observe(mid - start)
+        self.compress_time.observe(time.perf_counter() - mid)
+        self.payload_size.observe(len(body))
+        return latest, body
+
+    def __request_v1(self, series):
         ## Convert the timeseries into write request.
         import lancs_gridmon.metrics.remote_write_pb2 as pb
 
@@ -593,19 +3410,21 @@ class RemoteMetricsWriter:
         for labs, vals in series.items():
             ts = rw.timeseries.add()
 
-            ## Append the labels in order.
-            labnames = [ name for name in labs ]
-            labnames.sort()
-            for labname in labnames:
+            ## Append the labels, which are already in order.
+            for labname, labval in labs.items():
                 le = ts.labels.add()
                 le.name = labname
-                le.value = labs[labname]
+                le.value = labval
                 continue
 
             ## Append the samples.  They are already in order.
             ## Convert the timestamps in seconds to integer
-            ## milliseconds.
+            ## milliseconds.  Native histograms go separately.
             for stamp, value in vals:
+                if isinstance(value, _NativeValue):
+                    _rw_histogram(ts.histograms.add(), value, stamp,
+                                  self.__gauge(labs))
+                    continue
                 se = ts.samples.add()
                 se.value = value
                 se.timestamp = int(stamp * 1000)
@@ -613,56 +3432,133 @@ class RemoteMetricsWriter:
 
             continue
 
-        if self.endpoint is None:
-            print(rw)
-            return True
+        return rw
+
+    def __gauge(self, labs):
+        ## Determine whether a series belongs to a gauge histogram.
+        family = self.families.get(labs['__name__'])
+        return family is not None and family.type == 'gaugehistogram'
+
+    def __request_v2(self, series):
+        ## Convert the timeseries into a version-2 request.  Each
+        ## distinct string is stored once, and referred to by its
+        ## position in the symbol table, which must start with an
+        ## empty string.
+        import lancs_gridmon.metrics.remote_write_v2_pb2 as pb
+
+        symbols = { '': 0 }
+        def intern(text):
+            ref = symbols.get(text)
+            if ref is None:
+                ref = symbols[text] = len(symbols)
+                pass
+            return ref
 
-        ## Compress using Snappy block format.
-        import snappy
-        body = snappy.compress(rw.SerializeToString())
+        rw = pb.Request()
+        for labs, vals in series.items():
+            ts = rw.timeseries.add()
+
+            ## Append the label references, which are already in name
+            ## order.
+            refs = [ ]
+            for labname, labval in labs.items():
+                refs.append(intern(labname))
+                refs.append(intern(labval))
+                continue
+            ts.labels_refs.extend(refs)
+
+            ## Append the samples, which are already in order.  Native
+            ## histograms go separately.
+            for stamp, value in vals:
+                if isinstance(value, _NativeValue):
+                    _rw_histogram(ts.histograms.add(), value, stamp,
+                                  self.__gauge(labs))
+                    continue
+                se = ts.samples.add()
+                se.value = value
+                se.timestamp = int(stamp * 1000)
+                continue
+
+            ## Describe the series from its family.
+            family = self.families.get(labs['__name__'])
+            if family is not None:
+                ts.metadata.type = _rw2_types.get(family.type, 0)
+                if family.help is not None:
+                    ts.metadata.help_ref = intern(family.help)
+                    pass
+                if family.unit is not None:
+                    ts.metadata.unit_ref = intern(family.unit)
+                    pass
+                pass
+            continue
 
+        ## Dicts preserve insertion order, which is the order of the
+        ## references.
+        rw.symbols.extend(symbols)
+        return rw
+
+    def __post(self, body, expiry):
         ## POST to the endpoint, including headers, and the protobuf
-        ## message in Snappy block format.
-        from urllib import request
-        from urllib.error import URLError, HTTPError
-        import random
+        ## message in Snappy block format.  None is returned if the
+        ## writer was halted while waiting to retry.
+        from http.client import HTTPException
+        headers = {
+            'Content-Encoding': 'snappy',
+            'User-Agent': 'GridMon-remote-writer',
+        }
+        if self.protocol == '2.0':
+            headers['Content-Type'] = 'application/x-protobuf;' + \
+                'proto=io.prometheus.write.v2.Request'
+            headers['X-Prometheus-Remote-Write-Version'] = '2.0.0'
+        else:
+            headers['Content-Type'] = 'application/x-protobuf'
+            headers['X-Prometheus-Remote-Write-Version'] = '0.1.0'
+            pass
+        attempt = 0
         while True:
             try:
-                req = request.Request(self.endpoint, data=body)
-                req.add_header('Content-Encoding', 'snappy')
-                req.add_header('Content-Type', 'application/x-protobuf')
-                req.add_header('User-Agent', 'GridMon-remote-writer')
-                req.add_header('X-Prometheus-Remote-Write-Version', '0.1.0')
-                rsp = request.urlopen(req)
-                code = rsp.getcode()
-                logging.info('target %s response %d' % (self.endpoint, code))
-                if code >= 500 and code <= 599:
-                    now = time.time()
-                    delay = min(random.randint(240, 360), expiry - now - 1)
-                    if delay < 1:
-                        logging.error('target %s response %d; aborting' % \
-                                      (self.endpoint, code))
-                        return False
-                    logging.warning('target %s response %d; retrying in %ds' % \
-                                    (self.endpoint, code, delay))
-                    time.sleep(delay)
-                    continue
-                return True
-            except HTTPError as e:
-                logging.error('HTTP %d (%s) from target %s; aborting' %
-                              (e.code, e.reason, self.endpoint))
-                return False
-            except URLError as e:
-                now = time.time()
-                delay = min(random.randint(60, 120), expiry - now - 1)
-                if delay < 1:
-                    logging.error('no target %s "%s"; aborting' %
-                                  (self.endpoint, e.reason))
+                start = time.perf_counter()
+                try:
+                    code, reason, _ = \
+                        self.pool.request('POST', self.target, body, headers)
+                finally:
+                    self.post_time.observe(time.perf_counter() - start)
+                    pass
+                if code >= 200 and code <= 299:
+                    logging.info('target %s response %d' %
+                                 (self.endpoint, code))
+                    return True
+
+                ## Only server errors and throttling are worth
+                ## retrying.
+                if code < 500 and code != 429:
+                    logging.error('HTTP %d (%s) from target %s; aborting' %
+                                  (code, reason, self.endpoint))
                     return False
-                logging.warning('no target %s; retrying in %ds' % \
-                                (self.endpoint, delay))
-                time.sleep(delay)
-                continue
+                problem = 'response %d' % code
+                delay = _backoff(attempt, 60, expiry)
+            except (OSError, HTTPException) as e:
+                problem = 'no target "%s"' % e
+                delay = _backoff(attempt, 15, expiry)
+                pass
+
+            if delay is None:
+                logging.error('target %s %s; aborting' %
+                              (self.endpoint, problem))
+                return False
+            logging.warning('target %s %s; retrying in %ds' %
+                            (self.endpoint, problem, delay))
+            attempt += 1
+            with self.lock:
+                self.counters['retries'] += 1
+                pass
+            self.retry_count.inc()
+
+            ## Waiting is cut short if the writer is closed.
+            if self.__pause(delay):
+                logging.error('target %s abandoned' % self.endpoint)
+                return None
+            continue
         pass
 
     pass
@@ -758,8 +3654,90 @@ def keys_now(e, *args):
         return keys_now(e[args[0]], *args[1:])
     return list()
 
+## A step in a KeySelector's path matching any key
+_ANY = object()
+
+class KeySelector:
+    """A series-selection function returning the list of tuples of
+    keys that reach each node at a given depth of a tree, as
+    keys_now() does.  iter_select() and nodes() yield them lazily
+    instead.  The path consists of keys to follow, and integers giving
+    the number of levels at which all keys are taken.
+
+    """
+
+    def __init__(self, *args):
+        self.args = args
+        steps = [ ]
+        for arg in args:
+            if isinstance(arg, int):
+                steps.extend([ _ANY ] * max(arg, 0))
+            else:
+                steps.append(arg)
+                pass
+            continue
+        self.steps = tuple(steps)
+        pass
+
+    def __call__(self, e):
+        return list(self.iter_select(e))
+
+    def iter_select(self, e):
+        """Yield each tuple selected in the tree e."""
+        return (tup for tup, _ in self.nodes(e))
+
+    def __descend(self, node, i):
+        ## Follow fixed keys from step i, stopping before the next
+        ## step matching any key.  None is returned as the node if a
+        ## key is missing.
+        steps = self.steps
+        while i < len(steps) and steps[i] is not _ANY:
+            if steps[i] not in node:
+                return None, i
+            node = node[steps[i]]
+            i += 1
+            continue
+        return node, i
+
+    def nodes(self, e):
+        """Yield (tuple, node) for each node selected in the tree e."""
+        last = len(self.steps)
+        node, i = self.__descend(e, 0)
+        if node is None:
+            return
+        if i == last:
+            yield (), node
+            return
+
+        ## Keep a stack of iterators over the levels being scanned,
+        ## and the keys leading to each level below the first.
+        stack = [ (iter(node.items()), i) ]
+        keys = [ ]
+        while len(stack) > 0:
+            it, i = stack[-1]
+            for k, v in it:
+                sub, j = self.__descend(v, i + 1)
+                if sub is None:
+                    continue
+                if j == last:
+                    yield tuple(keys) + (k,), sub
+                    continue
+                keys.append(k)
+                stack.append((iter(sub.items()), j))
+                break
+            else:
+                stack.pop()
+                if len(keys) > 0:
+                    keys.pop()
+                    pass
+                pass
+            continue
+        pass
+
+    pass
+
 def keys(*args):
-    return lambda e: keys_now(e, *args)
+    return KeySelector(*args)
 
 def walk_now(t, d, *args):
     if len(args) == 0:
@@ -770,5 +3748,46 @@ def walk_now(t, d, *args):
         return walk_now(t[1:], d[t[0]], args[0] - 1, *args[1:])
     return walk_now(t, d[args[0]], *args[1:])
 
+class Walker:
+    """A sample or label function walking a tree as walk_now() does.
+    If its path extends that of a KeySelector, it can also be applied
+    to the node yielded by the selector, avoiding a descent from the
+    root.
+
+    """
+
+    def __init__(self, *args):
+        self.args = args
+        pass
+
+    def __call__(self, t, d):
+        return walk_now(t, d, *self.args)
+
+    def relative(self, selector):
+        """Get a function taking a node selected by 'selector', and
+        yielding the value this walker would reach.  None is returned
+        if the paths are incompatible.
+
+        """
+        n = len(selector.args)
+        if self.args[:n] != selector.args:
+            return None
+        rest = self.args[n:]
+        if any(isinstance(a, int) and a > 0 for a in rest):
+            return None
+        rest = tuple(a for a in rest if not isinstance(a, int))
+        if len(rest) == 0:
+            return lambda node: node
+        if len(rest) == 1:
+            return operator.itemgetter(rest[0])
+        def leaf(node):
+            for a in rest:
+                node = node[a]
+                continue
+            return node
+        return leaf
+
+    pass
+
 def walk(*args):
-    return lambda t, d: walk_now(t, d, *args)
+    return Walker(*args)
@@ -0,0 +1,569 @@
+## Copyright (c) 2026, Lancaster University
+## All rights reserved.
+##
+## Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions
+## are met:
+##
+## 1. Redistributions of source code must retain the above copyright
+##    notice, this list of conditions and the following disclaimer.
+##
+## 2. Redistributions in binary form must reproduce the above
+##    copyright notice, this list of conditions and the following
+##    disclaimer in the documentation and/or other materials provided
+##    with the distribution.
+##
+## 3. Neither the name of the copyright holder nor the names of its
+##    contributors may be used to endorse or promote products derived
+##    from this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+## "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+## LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+## FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+## COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+## INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+## (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+## SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+## HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+## STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+## ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+## OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## Benchmarks for the metrics machinery.  Run with:
+##
+##   python3 -m lancs_gridmon.metrics.bench [options]
+##
+## -s servers, -d domains, -v VOs and -k keys (perfSONAR tests and
+## Ceph disks) size the synthetic trees.  -t sets the number of
+## timestamps held by each history.  -w selects a workload (summary,
+## detail, cephhealth or perfsonar), and may be repeated.  -n sets
+## the size of the timestamp-index comparison (0 to skip it).  -e
+## selects the history's storage engine (tree or columnar).  -j
+## prints the results as JSON instead, so they can be compared between
+## releases.
+
+import time
+import bisect
+import random
+import tracemalloc
+
+from lancs_gridmon.metrics import MetricHistory, RemoteMetricsWriter
+from lancs_gridmon.metrics import compile_schema
+
+class _ScanningHistory:
+    """A stand-in for MetricHistory's old way of finding entries, by
+    scanning all timestamps to expire them, and scanning and sorting
+    them to find those newer than a client's timestamp.
+
+    """
+
+    def __init__(self, horizon):
+        self.horizon = horizon
+        self.entries = { }
+        pass
+
+    def install(self, samples, now):
+        self.entries.update(samples)
+        threshold = now - self.horizon
+        for k in [ k for k in self.entries if k < threshold ]:
+            del self.entries[k]
+            continue
+        pass
+
+    def since(self, ts):
+        ks = [ k for k in self.entries if k > ts ]
+        ks.sort()
+        return ks
+
+    pass
+
+def _time_it(action, count):
+    t0 = time.perf_counter()
+    for i in range(count):
+        action(i)
+        continue
+    return (time.perf_counter() - t0) / count
+
+def bench_history_index(count=10000, queries=1000):
+    """Compare the cost of installing one new timestamp (including
+    expiry), and of finding the entries newer than a recent
+    timestamp, when the history already holds 'count' timestamps.
+    Times are per operation, in seconds.
+
+    """
+    now = int(time.time())
+    base = now - count
+
+    ## Both histories expire against the same simulated clock, with
+    ## the same horizon.
+    clock = [ now ]
+    hist = MetricHistory(list(), horizon=count, clock=lambda: clock[0])
+    scan = _ScanningHistory(count)
+
+    ## Fill both histories with one timestamp per second, up to the
+    ## horizon.
+    for k in range(base, now):
+        hist.install({ k: { 'x': k } })
+        scan.install({ k: { 'x': k } }, now)
+        continue
+
+    ## Each install adds a timestamp, and expires the oldest.
+    def hist_install(i):
+        clock[0] = now + i
+        hist.install({ now + i: { 'x': i } })
+        pass
+    def scan_install(i):
+        scan.install({ now + i: { 'x': i } }, now + i)
+        pass
+    install = {
+        'index': _time_it(hist_install, queries),
+        'scan': _time_it(scan_install, queries),
+    }
+
+    ## Register a client for each query, then add ten more
+    ## timestamps.  Each query then gets the last ten entries, as a
+    ## regular scraper would.
+    seen = now + queries - 1
+    for i in range(queries):
+        hist.stream_message(i)
+        continue
+    for k in range(seen + 1, seen + 11):
+        clock[0] = k
+        hist.install({ k: { 'x': k } })
+        scan.install({ k: { 'x': k } }, k)
+        continue
+    def hist_query(i):
+        hist.stream_message(i)
+        pass
+    def scan_query(i):
+        scan.since(seen)
+        pass
+
+    return {
+        'timestamps': count,
+        'install': install,
+        'since': {
+            'index': _time_it(hist_query, queries),
+            'scan': _time_it(scan_query, queries),
+        },
+    }
+
+def _counter(rnd, ts):
+    return { 'value': rnd.randint(0, 10**9), 'zero': ts - 3600.0 }
+
+def make_summary(rnd, ts, servers=50, **kwargs):
+    """Make a tree like that produced by the XRootD summary converter,
+    for 'servers' hosts, each running xrootd and cmsd.
+
+    """
+    def counts(*names):
+        return { k: rnd.randint(0, 10**6) for k in names }
+    tree = { }
+    for i in range(servers):
+        for pgm in [ 'xrootd', 'cmsd' ]:
+            inst = ('host%d.example.org' % i, 'inst%d' % (i % 3), pgm)
+            node = tree[inst] = {
+                'start': ts - 86400,
+                'port': 1094,
+                'ver': 'v5.6.0',
+                'site': 'EXAMPLE',
+            }
+            node['buff'] = counts('reqs', 'mem', 'buffs', 'adj')
+            node['link'] = counts('num', 'maxn', 'tot', 'in', 'out',
+                                  'ctime', 'tmo', 'stall', 'sfps')
+            node['poll'] = counts('att', 'ev', 'en', 'int')
+            node['sched'] = counts('jobs', 'inq', 'maxinq', 'threads',
+                                   'idle', 'tcr', 'tde', 'tlimr')
+            node['cms'] = { 'role': 'server' }
+            node['sgen'] = counts('as', 'et', 'toe')
+            node['oss'] = {
+                'paths': {
+                    '/data%d' % j: {
+                        'rp': '/data%d' % j,
+                        'free': rnd.randint(0, 10**12),
+                        'tot': 10**12,
+                        'ifr': rnd.randint(0, 10**6),
+                        'ino': 10**6,
+                    } for j in range(4)
+                },
+                'spaces': {
+                    'public': counts('free', 'fsn', 'maxf', 'qta',
+                                     'tot', 'usg'),
+                },
+            }
+            node['ofs'] = counts('opr', 'opw', 'opp', 'ups', 'han', 'rdr',
+                                 'bxq', 'rep', 'err', 'dly', 'sok', 'ser')
+            node['ofs']['role'] = 'server'
+            node['ofs']['tpc'] = counts('grnt', 'deny', 'err', 'exp')
+            node['xrootd'] = counts('num', 'err', 'rdr', 'dly')
+            node['xrootd']['ops'] = counts('open', 'rf', 'rd', 'pr', 'rv',
+                                           'rs', 'wv', 'ws', 'wr', 'sync',
+                                           'getf', 'putf', 'misc')
+            node['xrootd']['sig'] = counts('ok', 'bad', 'ign')
+            node['xrootd']['aio'] = counts('num', 'max', 'rej')
+            node['xrootd']['lgn'] = counts('num', 'af', 'au', 'ua')
+            node['proc'] = {
+                'sys': rnd.random() * 1000,
+                'usr': rnd.random() * 1000,
+            }
+            continue
+        continue
+    return { 'summary': tree }
+
+def make_detail(rnd, ts, servers=50, domains=20, vos=5, **kwargs):
+    """Make a tree like that produced by the XRootD detail recorder, for
+    'servers' hosts, exchanging data with 'domains' peer domains on
+    behalf of 'vos' VOs.
+
+    """
+    ops = [ 'write', 'read', 'readv', 'closes', 'forced-closes' ]
+    stats = [ 'count', 'failure', 'success', 'volume', 'duration' ]
+    tree = { }
+    for i in range(servers):
+        srv = tree.setdefault('host%d.example.org' % i, { }) \
+                  .setdefault('inst%d' % (i % 3), { })
+        srv = srv.setdefault('xrootd', { })
+        for vo in range(vos):
+            void = 'vo%d' % vo
+            for dom in range(domains):
+                peer = 'dom%d.example.net' % dom
+                for drc in [ 'push', 'pull' ]:
+                    srv.setdefault('tpc', { }).setdefault(drc, { }) \
+                       .setdefault('4', { }).setdefault('https', { }) \
+                       .setdefault(void, { }).setdefault('1', { }) \
+                       .setdefault(peer, { })[peer] = \
+                           { k: _counter(rnd, ts) for k in stats }
+                    continue
+                leaf = { k: _counter(rnd, ts) for k in ops }
+                leaf['ip_version'] = {
+                    '4': {
+                        'auth': {
+                            'gsi': {
+                                k: _counter(rnd, ts)
+                                for k in [ 'disconnects', 'opens',
+                                           'rw-opens' ]
+                            },
+                        },
+                    },
+                }
+                srv.setdefault('prot', { }).setdefault('root', { }) \
+                   .setdefault(peer, { })[void] = leaf
+                continue
+            srv.setdefault('redir', { }).setdefault('4', { }) \
+               .setdefault('root', { }).setdefault('open', { }) \
+               .setdefault(void, { }) \
+               .setdefault('redirector.example.org', { })[1094] = \
+                   _counter(rnd, ts)
+            continue
+        srv['dicts'] = {
+            'skip': _counter(rnd, ts),
+            'unk': { 'u': { 'f': _counter(rnd, ts) } },
+        }
+        continue
+    return { 'detail': tree }
+
+def make_cephhealth(rnd, ts, keys=200, **kwargs):
+    """Make a tree like that produced by the Ceph health collector, for
+    'keys' disks and OSDs.
+
+    """
+    modes = [ 'read', 'write', 'verify' ]
+    disks = { }
+    osds = { }
+    for i in range(keys):
+        devid = 'VENDOR_MODEL_SERIAL%06d' % i
+        disk = disks[devid] = {
+            'path': 'pci-0000:00:%02x.0-scsi-0:0:%d:0' % (i // 32, i % 32),
+            'power_on_time': rnd.randint(0, 10**8),
+            'defects': rnd.randint(0, 10),
+        }
+        if i % 4 == 0:
+            for k in [ 'nvme_unsafe_shutdowns', 'nvme_errlog_entries',
+                       'nvme_media_errors', 'nvme_controller_busy',
+                       'nvme_power_cycles', 'nvme_power_on',
+                       'nvme_percentage_used', 'nvme_host_writes',
+                       'nvme_host_reads', 'nvme_data_units_read',
+                       'nvme_data_units_written' ]:
+                disk[k] = rnd.randint(0, 10**6)
+                continue
+            disk['nvme_temperature'] = 20 + rnd.random() * 30
+        else:
+            for k in [ 'uncorrected', 'invoked', 'processed' ]:
+                disk[k] = { m: rnd.randint(0, 10**6) for m in modes }
+                continue
+            pass
+        if i % 50 == 0:
+            osds[i] = {
+                'pg_complaints': {
+                    '%d.%x' % (i % 7, j): { 'pool_id': '%d' % (i % 7) }
+                    for j in range(3)
+                },
+            }
+            pass
+        continue
+    checks = {
+        'OSD_SCRUB_ERRORS': { 'count': 3, 'mute': False },
+        'PG_DAMAGED': { 'count': 1, 'mute': True },
+    }
+    return { 'disks': disks, 'osds': osds, 'checks': checks }
+
+def make_perfsonar(rnd, ts, keys=200, **kwargs):
+    """Make a tree like that produced by the perfSONAR collector, for
+    'keys' latency tests.
+
+    """
+    tree = { }
+    for i in range(keys):
+        tree['key%d' % i] = {
+            'measurements': {
+                'packet-count-lost': rnd.randint(0, 5),
+                'packet-count-sent': 600,
+                'histogram-owdelay': {
+                    '%.1f' % (x / 10): rnd.randint(0, 50)
+                    for x in range(1, 30)
+                },
+                'histogram-ttl': {
+                    str(x): rnd.randint(0, 50) for x in range(50, 60)
+                },
+            },
+            'counters': {
+                'histogram-owdelay': rnd.randint(0, 10**6),
+                'histogram-ttl': rnd.randint(0, 10**6),
+                'start': ts - 86400.0,
+            },
+            'source': '10.0.%d.%d' % (i // 250, i % 250),
+            'destination': '10.1.%d.%d' % (i // 250, i % 250),
+            'input-source': 'ps%d.example.org' % i,
+            'input-destination': 'ps%d.example.net' % i,
+            'measurement-agent': '10.0.0.1',
+            'measurement-peer': '10.1.0.1',
+            'input-measurement-agent': 'ps.example.org',
+            'input-measurement-peer': 'ps%d.example.net' % i,
+            'tool-name': 'owping',
+            'subject-type': 'point-to-point',
+            'pscheduler-test-type': 'latency',
+            'ip-transport-protocol': 'udp',
+        }
+        continue
+    return tree
+
+def _schema(name):
+    ## Import only the schema being measured.
+    if name == 'summary':
+        from lancs_gridmon.xrootd.summary import schema
+    elif name == 'detail':
+        from lancs_gridmon.xrootd.detail import schema
+    elif name == 'cephhealth':
+        from lancs_gridmon.ceph.health import schema
+    elif name == 'perfsonar':
+        from lancs_gridmon.perfsonar.collector import schema
+    else:
+        raise ValueError('unknown workload %s' % name)
+    return schema
+
+workloads = {
+    'summary': make_summary,
+    'detail': make_detail,
+    'cephhealth': make_cephhealth,
+    'perfsonar': make_perfsonar,
+}
+
+def _measure(action, trace):
+    ## Time an action, or record the peak memory allocated during it.
+    ## Tracing slows Python down, so both are not done at once.
+    if not trace:
+        t0 = time.perf_counter()
+        res = action()
+        return res, time.perf_counter() - t0
+    tracemalloc.start()
+    try:
+        res = action()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        pass
+    return res, peak
+
+def _run_workload(schema, data, trace, engine='tree'):
+    ## Perform each operation, yielding its name, output size and
+    ## time or peak memory.  The peak memory of installation shows
+    ## what the history allocates to retain the data, but not the
+    ## installed entries, which the tree engine keeps.
+    timestamps = len(data)
+    hist = MetricHistory(schema, horizon=timestamps * 60, engine=engine)
+    _, meas = _measure(lambda: hist.install(data), trace)
+    yield 'install', 0, meas, None
+    def scrape(ident):
+        text, _, _ = hist.get_message(ident)
+        return text
+    for op in [ 'render', 'render_shared' ]:
+        text, meas = _measure(lambda: scrape(op), trace)
+        yield op, len(text), meas, text
+        continue
+    hist.halt()
+
+    ## Register a client with another history before the last
+    ## snapshot arrives, so it is the only one left to render.
+    last = max(data)
+    hist = MetricHistory(schema, horizon=timestamps * 60, engine=engine)
+    hist.install({ k: v for k, v in data.items() if k != last })
+    hist.stream_message('latest')
+    hist.install({ last: data[last] })
+    text, meas = _measure(lambda: scrape('latest'), trace)
+    yield 'render_latest', len(text), meas, text
+    hist.halt()
+
+    ## Measure encoding of the latest snapshot.
+    latest = { max(data): data[max(data)] }
+    for protocol in [ '1.0', '2.0' ]:
+        wtr = RemoteMetricsWriter('http://localhost/', schema,
+                                  job='bench', protocol=protocol)
+        bodies, meas = _measure(lambda: wtr.encode(latest), trace)
+        yield 'encode_v' + protocol[0], sum(len(b) for b in bodies), \
+            meas, bodies
+        continue
+    pass
+
+def bench_workload(name, timestamps=3, seed=1, engine='tree', **params):
+    """Measure rendering and remote-write encoding of a synthetic tree.
+    'params' are passed to the tree generator.  A MetricHistory holding
+    'timestamps' snapshots, stored by 'engine', is installed, and
+    rendered for a new client, then again
+    for another new client (which can reuse the rendered text), and
+    then for a client that has seen all but the last snapshot.  One
+    snapshot is then encoded by a RemoteMetricsWriter for each
+    protocol version.  Everything is done twice, once for timing, and
+    once to find peak memory usage.  Times are in seconds, and memory
+    and output sizes in bytes.
+
+    """
+    rnd = random.Random(seed)
+    schema = compile_schema(_schema(name))
+    now = int(time.time())
+    data = { now - (timestamps - 1 - i) * 30:
+             workloads[name](rnd, now, **params)
+             for i in range(timestamps) }
+
+    res = { }
+    for op, size, elapsed, out in _run_workload(schema, data, False,
+                                                engine):
+        res[op] = {
+            'seconds': elapsed,
+            'bytes': size,
+        }
+        if op == 'render':
+            ## Count the sample lines.
+            lines = out.count('\n') - out.count('\n#') - \
+                (1 if out.startswith('#') else 0)
+            res['samples'] = lines // timestamps
+            pass
+        if op.startswith('encode'):
+            res[op]['requests'] = len(out)
+            pass
+        continue
+    for op, size, peak, out in _run_workload(schema, data, True, engine):
+        res[op]['peak'] = peak
+        continue
+    for op in [ 'render', 'encode_v1', 'encode_v2' ]:
+        count = res['samples']
+        if op == 'render':
+            count *= timestamps
+            pass
+        res[op]['samples_per_second'] = count / res[op]['seconds']
+        continue
+    return res
+
+def bench_suite(names=None, timestamps=3, count=10000, engine='tree',
+                **params):
+    """Run the benchmark for each named workload (or all of them), and
+    the timestamp-index comparison with 'count' timestamps.  The
+    result can be serialized as JSON.
+
+    """
+    import sys
+    import platform
+    if names is None:
+        names = list(workloads)
+        pass
+    res = {
+        'when': time.time(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'params': dict(params, timestamps=timestamps, engine=engine),
+        'workloads': { },
+    }
+    for name in names:
+        res['workloads'][name] = bench_workload(name, timestamps=timestamps,
+                                                engine=engine, **params)
+        continue
+    if count > 0:
+        res['history_index'] = bench_history_index(count)
+        pass
+    return res
+
+if __name__ == '__main__':
+    import sys
+    import json
+    from getopt import gnu_getopt
+
+    count = 10000
+    params = { }
+    names = None
+    timestamps = 3
+    engine = 'tree'
+    as_json = False
+    opts, args = gnu_getopt(sys.argv[1:], 'n:s:d:v:k:t:w:e:j')
+    for opt, val in opts:
+        if opt == '-n':
+            count = int(val)
+        elif opt == '-s':
+            params['servers'] = int(val)
+        elif opt == '-d':
+            params['domains'] = int(val)
+        elif opt == '-v':
+            params['vos'] = int(val)
+        elif opt == '-k':
+            params['keys'] = int(val)
+        elif opt == '-t':
+            timestamps = int(val)
+        elif opt == '-w':
+            if names is None:
+                names = list()
+                pass
+            names.append(val)
+        elif opt == '-e':
+            engine = val
+        elif opt == '-j':
+            as_json = True
+            pass
+        continue
+
+    res = bench_suite(names, timestamps=timestamps, count=count,
+                      engine=engine, **params)
+    if as_json:
+        json.dump(res, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        sys.exit(0)
+
+    for name, wres in res['workloads'].items():
+        print('%s: %d samples per snapshot' % (name, wres['samples']))
+        for op in [ 'install', 'render', 'render_shared', 'render_latest',
+                    'encode_v1', 'encode_v2' ]:
+            opr = wres[op]
+            print('  %-14s %9.3fs %11d bytes  peak %11d bytes' %
+                  (op, opr['seconds'], opr['bytes'], opr['peak']))
+            continue
+        continue
+
+    if 'history_index' in res:
+        res = res['history_index']
+        print('%d timestamps' % res['timestamps'])
+        for op in [ 'install', 'since' ]:
+            idx = res[op]['index']
+            scn = res[op]['scan']
+            print('%-8s index %9.2fus  scan %9.2fus  (x%.1f)' %
+                  (op, idx * 1e6, scn * 1e6, scn / idx))
+            continue
+        pass
+    pass
@@ -110,6 +110,46 @@ def _histo(rbucks, mean=lambda lwr, upr: (lwr + upr) / 2.0):
     result['count'] = gcount
     return result
 
+def _observations(rbucks, mean=lambda lwr, upr: (lwr + upr) / 2.0):
+    ## Treat each bucket as observations of a single value.
+    res = [ ]
+    for thr, cnt in rbucks.items():
+        _, lwr, upr, cnt = _bucket(thr, cnt)
+        res.append((mean(lwr, upr), cnt))
+        continue
+    return res
+
+## The histogram families, the event types they're derived from, and
+## how to get a representative value of each bucket
+_histograms = {
+    'perfsonar_owdelay': ('histogram-owdelay',
+                          lambda lwr, upr: (lwr + upr) / 2.0),
+    'perfsonar_ttl': ('histogram-ttl',
+                      lambda lwr, upr: lwr),
+}
+
+def _native_value(evtype, mean, t, d):
+    return _observations(d[t[0]]['measurements'][evtype], mean=mean)
+
+def native_schema(schema, fmt):
+    """Get a copy of the schema whose histogram families yield native
+    histograms in the format 'fmt', a metrics.NativeHistogram, instead
+    of classic ones.
+
+    """
+    res = [ ]
+    for fam in schema:
+        spec = _histograms.get(fam['base'])
+        if spec is not None:
+            fam = dict(fam)
+            fam['samples'] = {
+                '': (fmt, functools.partial(_native_value, *spec)),
+            }
+            pass
+        res.append(fam)
+        continue
+    return res
+
 schema = [
     {
         'base': 'perfsonar_packets_lost',
@@ -470,7 +510,7 @@ class PerfsonarCollector:
     pass
 
 if __name__ == "__main__":
-    from http.server import HTTPServer
+    from http.server import ThreadingHTTPServer
     from getopt import getopt
     import threading
     import errno
@@ -491,12 +531,13 @@ if __name__ == "__main__":
     aft = 60
     pidfile = None
     forced_host = None
+    native = None
     log_params = {
         'format': '%(asctime)s %(levelname)s %(message)s',
         'datefmt': '%Y-%m-%dT%H:%M:%S',
     }
     opts, args = getopt(sys.argv[1:], "zh:t:T:E:M:S:l:f:a:H:",
-                        [ 'log=', 'log-file=', 'pid-file=' ])
+                        [ 'log=', 'log-file=', 'pid-file=', 'native=' ])
     for opt, val in opts:
         if opt == '-h':
             horizon = int(val) * 60
@@ -535,6 +576,8 @@ if __name__ == "__main__":
             pidfile = val
         elif opt == '-S':
             endpoint = 'https://' + val + '/esmond/perfsonar/archive/'
+        elif opt == '--native':
+            native = int(val)
             pass
         continue
 
@@ -556,14 +599,18 @@ if __name__ == "__main__":
         signal.signal(signal.SIGHUP, handler)
         pass
 
-    methist = metrics.MetricHistory(schema, horizon=horizon)
+    if native is not None:
+        schema = native_schema(schema, metrics.NativeHistogram(schema=native))
+        pass
+    compiled_schema = metrics.compile_schema(schema)
+    methist = metrics.MetricHistory(compiled_schema, horizon=horizon)
     perfcoll = PerfsonarCollector(endpoint, lag=lag, fore=fore, aft=aft,
                                   forced_host=forced_host)
     if metrics_endpoint is None:
         hist = methist
     else:
         hist = metrics.RemoteMetricsWriter(endpoint=metrics_endpoint,
-                                           schema=schema,
+                                           schema=compiled_schema,
                                            job='perfsonar',
                                            expiry=10*60)
         pass
@@ -573,7 +620,8 @@ if __name__ == "__main__":
     ## which doesn't seem to be possible with remote-write.
     partial_handler = functools.partial(metrics.MetricsHTTPHandler, hist=methist)
     try:
-        webserver = HTTPServer((http_host, http_port), partial_handler)
+        webserver = ThreadingHTTPServer((http_host, http_port),
+                                        partial_handler)
     except OSError as e:
         if e.errno == errno.EADDRINUSE:
             sys.stderr.write('Stopping: address in use: %s:%d\n' % \
@@ -593,7 +641,7 @@ if __name__ == "__main__":
 
         ## Use a separate thread to run the server, which we can stop by
         ## calling shutdown().
-        srv_thrd = threading.Thread(target=HTTPServer.serve_forever,
+        srv_thrd = threading.Thread(target=ThreadingHTTPServer.serve_forever,
                                     args=(webserver,),
                                     daemon=True)
         srv_thrd.start()
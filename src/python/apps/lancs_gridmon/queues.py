@@ -36,6 +36,7 @@ import os
 import filelock
 import threading
 import logging
+import collections
 from pathlib import Path
 
 _fnfmt = re.compile('^queue-([0-9a-fA-F]+).chk$')
@@ -46,12 +47,13 @@ class _Chunk:
         self._stamp = stamp
         self._path = path
         if new:
-            self._handle = open(self._path, 'wb+')
+            ## Never overwrite an existing chunk.
+            self._handle = open(self._path, 'xb+')
             self._size = 0
             self._count = 0
             self._handle.write(self._size.to_bytes(4, byteorder='big'))
             self._handle.write(self._count.to_bytes(2, byteorder='big'))
-            logging.debug('%s:%s new open wb+' % (self._name, self._path))
+            logging.debug('%s:%s new open xb+' % (self._name, self._path))
         else:
             self._handle = None
             with open(self._path, 'rb') as fh:
@@ -176,11 +178,19 @@ class PersistentQueue:
 
         self._complete = False
 
-        self._mem_elems = list()
+        ## Elements are popped from the front of the in-memory stage,
+        ## so it is a deque, not a list, which would have to move all
+        ## the remaining elements each time.
+        self._mem_elems = collections.deque()
         self._mem_size = 0
         self._disk_size = 0
         self._disk_count = 0
 
+        ## A chunk loaded into memory is kept on disc until all its
+        ## elements have been handed out, and the consumer has come
+        ## back for more, so a crash can't lose any of them.
+        self._loaded = None
+
         ## Load in chunks, and sort them by their timestamp.
         chunks = dict()
         for fp in self._dir.iterdir():
@@ -193,6 +203,10 @@ class PersistentQueue:
             chunks[ts] = _Chunk(ts, fp, name=self._name)
             continue
         self._chunks = [ chunks[k] for k in sorted(chunks) ]
+        for ch in self._chunks:
+            self._disk_size += ch._size
+            self._disk_count += ch._count
+            continue
 
         self.__repop()
         pass
@@ -200,8 +214,19 @@ class PersistentQueue:
     def __chunk_path(self, stamp):
         return self._dir / ('queue-%016x.chk' % stamp)
 
+    def __release(self):
+        ## Delete the chunk last loaded into memory.
+        if self._loaded is None:
+            return
+        self._loaded.unlink()
+        self._loaded = None
+        pass
+
     def __repop(self):
-        ## Populate the in-memory queue from the first chunk.
+        ## Populate the in-memory queue from the first chunk.  The
+        ## memory must be empty, so anything loaded before has been
+        ## consumed.
+        self.__release()
         if len(self._chunks) == 0:
             return
         for header, body in self._chunks[0]:
@@ -211,7 +236,7 @@ class PersistentQueue:
             self._disk_size -= len(body)
             self._disk_count -= 1
             continue
-        self._chunks[0].unlink()
+        self._loaded = self._chunks[0]
 
         ## If there's any truncation, the chunk's counters will be
         ## non-zero.
@@ -259,8 +284,13 @@ class PersistentQueue:
                 stamp = None
                 if len(self._chunks) == 0:
                     ## We have no chunks, so we definitely need a new
-                    ## one.  Use the current time as a timestamp.
+                    ## one.  Use the current time as a timestamp, or
+                    ## one more than that of a loaded chunk still on
+                    ## disc.
                     stamp = int(time.time() * 1000)
+                    if self._loaded is not None:
+                        stamp = self._loaded.next_time(stamp)
+                        pass
                 elif self._chunks[-1].too_much(bsz, self._chunk_size):
                     ## The last chunk is full, so use the current time
                     ## as the timestamp, or one more than the last
@@ -271,7 +301,6 @@ class PersistentQueue:
                     pass
                 if stamp is not None:
                     ## Make a new chunk.
-                    stamp = int(time.time() * 1000)
                     path = self.__chunk_path(stamp)
                     self._chunks.append(_Chunk(stamp, path, name=self._name,
                                                new=True))
@@ -284,6 +313,10 @@ class PersistentQueue:
                 self._chunks[-1].append(ehdr, body)
                 self._disk_count += 1
                 self._disk_size += len(body)
+
+                ## The consumer might be waiting with nothing in
+                ## memory.
+                self._cond.notify()
             else:
                 ## Add to the in-memory queue.
                 self._mem_elems.append((header, body))
@@ -297,33 +330,58 @@ class PersistentQueue:
 
     def pop(self):
         with self._cond:
+            ## Anything already handed out has been dealt with, so
+            ## an emptied chunk can go.
+            if len(self._mem_elems) == 0:
+                self.__release()
+                pass
             while not self._complete and len(self._mem_elems) == 0:
+                ## Elements can go straight to disc if a big one
+                ## arrives while memory is empty, so look there
+                ## before waiting.
+                if len(self._chunks) > 0:
+                    self.__repop()
+                    continue
                 self._cond.wait()
                 continue
             if self._complete:
                 raise Shutdown()
-            header, body = self._mem_elems[0]
-            del self._mem_elems[0]
+            header, body = self._mem_elems.popleft()
             self._mem_size -= len(body)
-            if len(self._mem_elems) == 0:
-                self.__repop()
-                pass
             if len(self._mem_elems) > 0:
                 self._cond.notify()
                 pass
             return (header, body)
         pass
 
+    def restore(self, header, body):
+        """Return an element to the head of the queue, after it was
+        popped but could not be processed.  This is permitted even
+        after shutdown, so that close() will save the element.
+
+        """
+        with self._cond:
+            self._mem_elems.appendleft((header, body))
+            self._mem_size += len(body)
+            self._cond.notify()
+            pass
+        pass
+
     def close(self):
         self.shutdown()
         with self._cond:
             if len(self._mem_elems) == 0:
+                self.__release()
+                self._file_lock.release()
                 return
 
             ## For a new leading chunk, choose either the current
-            ## time, or a moment before the current leading chunk.
-            stamp = self._chunks[0].prev_time() \
-                if len(self._chunks) > 0 \
+            ## time, or a moment before the current leading chunk and
+            ## the loaded chunk, which is still on disc.
+            firsts = [ ch for ch in self._chunks[:1] + [ self._loaded ]
+                       if ch is not None ]
+            stamp = min(ch.prev_time() for ch in firsts) \
+                if len(firsts) > 0 \
                 else int(time.time() * 1000)
 
             ## Create the chunk, and save the in-memory elements to
@@ -335,28 +393,119 @@ class PersistentQueue:
                 continue
 
             ## Clear and release resources.
-            self._mem_elems = list()
+            self._mem_elems.clear()
             self._mem_size = 0
             self._mem_count = 0
             self._disk_count = 0
             self._disk_size = 0
             self._chunks = list()
             ch0.complete()
+
+            ## The saved elements include any from the loaded chunk.
+            self.__release()
             self._file_lock.release()
             pass
         pass
 
     pass
 
+def _bench(count, sample=10000):
+    ## Measure the in-memory stage.  Pops per second are measured
+    ## with 'count' elements waiting, for a list (as the stage used to
+    ## be) and a deque, using a sample of pops, as popping all of a
+    ## long list would take too long.  Then elements per second are
+    ## measured for pushing 'count' elements through a queue big
+    ## enough to hold them all in memory, and popping them all.
+    import tempfile
+    elem = (b'', b'x' * 64)
+    sample = min(sample, count)
+    res = { }
+    for name, make, take in [ ('list', list, lambda st: st.pop(0)),
+                              ('deque', collections.deque,
+                               lambda st: st.popleft()) ]:
+        stage = make([ elem ] * count)
+        t0 = time.perf_counter()
+        for _ in range(sample):
+            take(stage)
+            continue
+        res[name] = sample / (time.perf_counter() - t0)
+        continue
+    with tempfile.TemporaryDirectory() as path:
+        q = PersistentQueue(path, ram_size=count * len(elem[1]))
+        t0 = time.perf_counter()
+        for _ in range(count):
+            q.push(*elem)
+            continue
+        t1 = time.perf_counter()
+        for _ in range(count):
+            q.pop()
+            continue
+        t2 = time.perf_counter()
+        q.shutdown()
+        q.close()
+        pass
+    res['push'] = count / (t1 - t0)
+    res['pop'] = count / (t2 - t1)
+    return res
+
+def _check():
+    ## Check that elements survive being popped from a loaded chunk,
+    ## the queue being closed, and reopened, and that a chunk made
+    ## while the loaded one is still on disc doesn't replace it.
+    ## Failures raise AssertionError.
+    import tempfile
+    elems = [ (b'', (b'%d' % i) + b'x' * 59) for i in range(6) ]
+    with tempfile.TemporaryDirectory() as path:
+        q = PersistentQueue(path, chunk_size=130, ram_size=0)
+        for elem in elems:
+            q.push(*elem)
+            continue
+        assert q.pop() == elems[0]
+        q.close()
+        q = PersistentQueue(path, chunk_size=130, ram_size=0)
+        got = [ ]
+        while q.stats()['mem_count'] + q.stats()['disk_count'] > 0:
+            got.append(q.pop())
+            continue
+        assert got == elems[1:], got
+        q.push(*elems[0])
+        assert q.pop() == elems[0]
+        q.close()
+        q = PersistentQueue(path, chunk_size=130, ram_size=0)
+        assert q.stats()['mem_count'] + q.stats()['disk_count'] == 0
+        q.close()
+        pass
+    pass
+
 if __name__ == '__main__':
+    import sys
+    from getopt import gnu_getopt
+
+    ## -b COUNT benchmarks the in-memory stage with COUNT elements.
+    ## -t checks that closing and reopening loses nothing.
+    opts, args = gnu_getopt(sys.argv[1:], 'a:rb:t')
+    if ('-t', '') in opts:
+        _check()
+        print('ok')
+        sys.exit(0)
+
+    counts = [ int(val) for opt, val in opts if opt == '-b' ]
+    if len(counts) > 0:
+        for count in counts:
+            res = _bench(count)
+            print('%d elements' % count)
+            print('  stage pops/s  list %12.0f  deque %12.0f  (x%.1f)' %
+                  (res['list'], res['deque'], res['deque'] / res['list']))
+            print('  queue elems/s push %12.0f  pop   %12.0f' %
+                  (res['push'], res['pop']))
+            continue
+        sys.exit(0)
+
     logging.basicConfig(level=logging.DEBUG,
                         format='%(asctime)s %(levelname)s %(message)s',
                         datefmt='%Y-%m-%dT%H:%M:%SZ')
-    import sys
-    from getopt import gnu_getopt
     q = PersistentQueue('/tmp/test.queue', chunk_size=32)
     try:
-        opts, args = gnu_getopt(sys.argv[1:], 'a:r')
         for opt, val in opts:
             if opt == '-a':
                 q.push(b'', val.encode('utf-8'))
@@ -42,7 +42,7 @@ import subprocess
 import re
 from pprint import pprint
 import functools
-from http.server import HTTPServer
+from http.server import ThreadingHTTPServer
 import threading
 import errno
 import socket
@@ -163,6 +163,8 @@ ssl_interval = 6 * 60 * 60
 silent = False
 horizon = 120
 metrics_endpoint = None
+keepalive = None
+refresh = 0
 pidfile = None
 log_params = {
     'format': '%(asctime)s %(levelname)s %(message)s',
@@ -170,7 +172,8 @@ log_params = {
 }
 confs = list()
 opts, args = getopt(sys.argv[1:], "zh:t:T:M:f:",
-                    [ 'log=', 'log-file=', 'pid-file=' ])
+                    [ 'log=', 'log-file=', 'pid-file=', 'keepalive=',
+                      'refresh-interval=' ])
 for opt, val in opts:
     if opt == '-z':
         silent = True
@@ -184,6 +187,10 @@ for opt, val in opts:
         http_port = int(val)
     elif opt == '-M':
         metrics_endpoint = val
+    elif opt == '--keepalive':
+        keepalive = int(val)
+    elif opt == '--refresh-interval':
+        refresh = int(val)
     elif opt == '--log':
         log_params['level'] = getattr(logging, val.upper(), None)
         if not isinstance(log_params['level'], int):
@@ -221,24 +228,25 @@ if 'filename' in log_params:
     pass
 
 ## Serve HTTP metric documentation.
+statics_schema = metrics.compile_schema(statics_schema)
 methist = metrics.MetricHistory(statics_schema, horizon=horizon)
 if metrics_endpoint is None:
     hist = methist
 else:
     hist = metrics.RemoteMetricsWriter(endpoint=metrics_endpoint,
                                        schema=statics_schema,
-                                       job='statics', expiry=horizon)
+                                       job='statics', expiry=horizon,
+                                       keepalive=keepalive)
     pass
 
 ## Serve the history on demand.  Even if we don't store anything
 ## in the history, the HELP, TYPE and UNIT strings are exposed,
 ## which doesn't seem to be possible with remote-write.
 updater = functools.partial(_update_live_metrics, methist, confs)
-partial_handler = functools.partial(metrics.MetricsHTTPHandler,
-                                    hist=methist,
-                                    prescrape=updater)
+partial_handler = methist.http_handler(prescrape=updater, interval=refresh)
 try:
-    webserver = HTTPServer((http_host, http_port), partial_handler)
+    webserver = ThreadingHTTPServer((http_host, http_port),
+                                    partial_handler)
 except OSError as e:
     if e.errno == errno.EADDRINUSE:
         sys.stderr.write('Stopping: address in use: %s:%d\n' % \
@@ -261,7 +269,7 @@ try:
 
     ## Use a separate thread to run the server, which we can stop by
     ## calling shutdown().
-    srv_thrd = threading.Thread(target=HTTPServer.serve_forever,
+    srv_thrd = threading.Thread(target=ThreadingHTTPServer.serve_forever,
                                 args=(webserver,),
                                 daemon=True)
     srv_thrd.start()
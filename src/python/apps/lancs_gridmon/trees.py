@@ -74,6 +74,42 @@ def merge_trees(a, b, pfx=(), mismatch=0):
         continue
     pass
 
+def merged_trees(a, b, pfx=(), mismatch=0):
+    """Merge two trees as merge_trees does, but without modifying
+    either.  A new tree is returned, sharing with the originals any
+    subtrees unaffected by the merge.
+
+    """
+    res = dict(a)
+    for key, nv in b.items():
+        ## Add a value if not already present.
+        if key not in res:
+            res[key] = nv
+            continue
+
+        ## Compare the old value with the new.  Apply recursively if
+        ## they are both dictionaries.
+        ov = res[key]
+        if isinstance(ov, dict) and isinstance(nv, dict):
+            res[key] = merged_trees(ov, nv, pfx + (key,), mismatch=mismatch)
+            continue
+
+        if mismatch < 0:
+            ## Use the old value.
+            continue
+        if mismatch > 0:
+            ## Replace the old value.
+            res[key] = nv
+            continue
+
+        ## The new value and the existing value must match.
+        if ov != nv:
+            raise Exception('bad merge (%s over %s at %s)' %
+                            (nv, ov, '.'.join(pfx + (key,))))
+
+        continue
+    return res
+
 def tree_size(node):
     res = sys.getsizeof(node)
     if isinstance(node, dict):
@@ -87,3 +123,23 @@ def tree_size(node):
             continue
         pass
     return res
+
+def merged_size(a, b):
+    """Estimate how much merging tree b into tree a, as merge_trees()
+    and merged_trees() do, adds to tree_size(a).  Only b is walked,
+    so the size of a growing tree can be kept up to date as parts are
+    merged into it.  Replaced values are assumed not to change the
+    size.
+
+    """
+    res = 0
+    for key, nv in b.items():
+        if key not in a:
+            res += tree_size(key) + tree_size(nv)
+            continue
+        ov = a[key]
+        if isinstance(ov, dict) and isinstance(nv, dict):
+            res += merged_size(ov, nv)
+            pass
+        continue
+    return res
@@ -39,7 +39,7 @@ import functools
 import time
 import socket
 from socketserver import UDPServer
-from http.server import HTTPServer
+from http.server import ThreadingHTTPServer
 
 import lancs_gridmon.metrics as metrics
 import lancs_gridmon.apps as apputils
@@ -120,12 +120,23 @@ def get_config(raw_args):
             'scrape': {
                 'host': 'localhost',
                 'port': 8743,
+                'refresh_interval': '0s',
             },
             'push': {
                 'endpoint': None,
                 'summary_job': 'xrootd',
                 'detail_job': 'xrootd_detail',
                 'labels': dict(),
+                'queue_limit': 64,
+                'flush_interval': '5s',
+                'protocol': '1.0',
+                'keepalive': None,
+                'rollup': None,
+                'spool': {
+                    'path': None,
+                    'size_limit': '64M',
+                    'age_limit': '1h',
+                },
             },
             'log': '/tmp/xrootd-detail-{instance}.log',
         },
@@ -156,6 +167,7 @@ def get_config(raw_args):
             'domains': {
                 'filename': None,
             },
+            'budgets': dict(),
         },
     }
 
@@ -240,12 +252,33 @@ def get_config(raw_args):
     convert_memory(config, 'source', 'xrootd', 'queue', 'chunk_size')
     convert_memory(config, 'source', 'xrootd', 'queue', 'ram_size')
     convert_memory(config, 'source', 'xrootd', 'rcvbuf')
+    convert_memory(config, 'destination', 'push', 'spool', 'size_limit')
+    convert_duration(config, 'destination', 'push', 'flush_interval')
+    convert_duration(config, 'destination', 'push', 'keepalive')
+    if isinstance(config['destination']['push']['rollup'], dict):
+        convert_duration(config, 'destination', 'push', 'rollup', 'window')
+        convert_duration(config, 'destination', 'push', 'rollup', 'timeout')
+        if convert_duration(config, 'destination', 'push', 'rollup',
+                            'grace') and \
+           config['destination']['push']['rollup']['grace'] is None:
+            config['destination']['push']['rollup']['grace'] = 0
+            pass
+    else:
+        convert_duration(config, 'destination', 'push', 'rollup')
+        pass
+    convert_duration(config, 'destination', 'push', 'spool', 'age_limit')
     convert_duration(config, 'data', 'purge')
     convert_duration(config, 'data', 'peers', 'timeout')
     convert_duration(config, 'data', 'dictids', 'timeout')
     convert_duration(config, 'data', 'dictids', 'short_timeout')
     convert_duration(config, 'data', 'sequencing', 'timeout')
     convert_duration(config, 'data', 'horizon')
+    convert_duration(config, 'destination', 'scrape', 'refresh_interval')
+    for base, budget in config['data']['budgets'].items():
+        if isinstance(budget, dict):
+            convert_duration(budget, 'timeout')
+            pass
+        continue
     if 'level' in config['process']['log']:
         if isinstance(config['process']['log']['level'], str):
             config['process']['log']['level'] = \
@@ -266,6 +299,7 @@ if config['process']['silent']:
 
 normalize_path(config['source']['pcap'], 'filename')
 normalize_path(config['destination'], 'log')
+normalize_path(config['destination']['push']['spool'], 'path')
 normalize_path(config['data']['domains'], 'filename')
 normalize_path(config['process']['log'], 'filename')
 normalize_path(config['process'], 'id_filename')
@@ -294,12 +328,37 @@ else:
 ## Map XRootD dictids, LFN path prefixes and usernames to VO names.
 vo_db = WatchingVODatabase(**config['data']['organizations'])
 
+## Prepare the schemata once, as they are shared by the writers and
+## the scrape endpoint.
+xrootd_summary_schema = metrics.compile_schema(xrootd_summary_schema)
+xrootd_detail_schema = metrics.compile_schema(xrootd_detail_schema)
+
+## Unsent remote-write requests can be kept on disc, in a separate
+## directory for each writer.
+def push_spool(name):
+    path = config['destination']['push']['spool']['path']
+    if path is None:
+        return None
+    path = os.path.join(path, name)
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
+
 ## Prepare to process summary messages.
 sum_wtr = metrics.RemoteMetricsWriter(
     endpoint=config['destination']['push']['endpoint'],
     schema=xrootd_summary_schema,
     job=config['destination']['push']['summary_job'],
     labels=config['destination']['push']['labels'],
+    asynchronous=True,
+    queue_limit=config['destination']['push']['queue_limit'],
+    flush_interval=config['destination']['push']['flush_interval'],
+    protocol=config['destination']['push']['protocol'],
+    keepalive=config['destination']['push']['keepalive'],
+    rollup=config['destination']['push']['rollup'],
+    log=push_spool('summary'),
+    log_limit=config['destination']['push']['spool']['size_limit'],
+    log_age=config['destination']['push']['spool']['age_limit'],
+    budgets=config['data']['budgets'],
     expiry=10*60)
 sum_proc = XRootDSummaryConverter(sum_wtr)
 
@@ -309,6 +368,15 @@ det_wtr = metrics.RemoteMetricsWriter(
     schema=xrootd_detail_schema,
     job=config['destination']['push']['detail_job'],
     labels=config['destination']['push']['labels'],
+    asynchronous=True,
+    queue_limit=config['destination']['push']['queue_limit'],
+    flush_interval=config['destination']['push']['flush_interval'],
+    protocol=config['destination']['push']['protocol'],
+    keepalive=config['destination']['push']['keepalive'],
+    log=push_spool('detail'),
+    log_limit=config['destination']['push']['spool']['size_limit'],
+    log_age=config['destination']['push']['spool']['age_limit'],
+    budgets=config['data']['budgets'],
     expiry=10*60)
 det_rec = XRootDDetailRecorder(now, config['destination']['log'], det_wtr,
                                epoch=epoch,
@@ -615,18 +683,24 @@ meta_schema = [
 ]
 
 ## Serve the combined schemata's documentation.  Use a separate
-## thread.  There are no thread-safety considerations, as there is no
-## shared mutable data.
+## thread, which itself serves each request in its own thread.  The
+## history renders snapshots of its data, so scrapes do not hold up
+## updates.
 www_hist = metrics.MetricHistory(xrootd_summary_schema + \
                                  xrootd_detail_schema + \
                                  meta_schema,
-                                 horizon=30)
+                                 horizon=30,
+                                 budgets=config['data']['budgets'])
 www_updater = functools.partial(update_live_metrics, now, det_proc,
                                 www_hist)
-www_srv = HTTPServer((config['destination']['scrape']['host'],
-                      config['destination']['scrape']['port']),
-                     www_hist.http_handler(prescrape=www_updater))
-www_thrd = threading.Thread(target=HTTPServer.serve_forever, args=(www_srv,))
+www_srv = ThreadingHTTPServer((config['destination']['scrape']['host'],
+                               config['destination']['scrape']['port']),
+                              www_hist.http_handler(
+                                  prescrape=www_updater,
+                                  interval=config['destination']['scrape']\
+                                  ['refresh_interval']))
+www_thrd = threading.Thread(target=ThreadingHTTPServer.serve_forever,
+                            args=(www_srv,))
 
 with apputils.ProcessIDFile(config['process']['id_filename']):
     www_thrd.start()
@@ -647,5 +721,9 @@ with apputils.ProcessIDFile(config['process']['id_filename']):
     www_hist.halt()
     www_srv.shutdown()
     www_srv.server_close()
+
+    ## Give the writers a chance to send what they have left.
+    sum_wtr.close(timeout=30)
+    det_wtr.close(timeout=30)
     
     pass
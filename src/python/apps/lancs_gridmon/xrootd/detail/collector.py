@@ -1037,7 +1037,7 @@ class Detailer:
     pass
 
 import lancs_gridmon.metrics as metrics
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import threading
 
 if __name__ == '__main__':
@@ -1105,10 +1105,11 @@ if __name__ == '__main__':
     logging.basicConfig(**log_params)
 
     ## This serves no metrics, only the documentation.
-    history = metrics.MetricHistory(xrootd_detail_schema, horizon=30)
+    schema = metrics.compile_schema(xrootd_detail_schema)
+    history = metrics.MetricHistory(schema, horizon=30)
 
     rmw = metrics.RemoteMetricsWriter(endpoint=endpoint,
-                                      schema=xrootd_detail_schema,
+                                      schema=schema,
                                       job='xrootd_detail',
                                       expiry=10*60)
 
@@ -1124,7 +1125,8 @@ if __name__ == '__main__':
 
     partial_handler = functools.partial(metrics.MetricsHTTPHandler,
                                         hist=history)
-    webserver = HTTPServer((http_host, http_port), partial_handler)
+    webserver = ThreadingHTTPServer((http_host, http_port),
+                                    partial_handler)
     logging.info('Created HTTP server on http://%s:%d' %
                  (http_host, http_port))
 
@@ -1140,7 +1142,7 @@ if __name__ == '__main__':
 
         ## Use a separate thread to run the server, which we can stop
         ## by calling shutdown().
-        srv_thrd = threading.Thread(target=HTTPServer.serve_forever,
+        srv_thrd = threading.Thread(target=ThreadingHTTPServer.serve_forever,
                                     args=(webserver,))
         srv_thrd.start()
 
@@ -261,7 +261,7 @@ if __name__ == '__main__':
     import time
     import threading
     from pprint import pprint
-    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
     import functools
     import sys
     import os
@@ -464,11 +464,11 @@ if __name__ == '__main__':
     ## Record XRootD stats history, indexed by timestamp and instance.
     ## Alternatively, prepare to push stats as soon as they're
     ## converted.
-    rmw = history = metrics.MetricHistory(xrootd_summary_schema,
-                                          horizon=horizon)
+    schema = metrics.compile_schema(xrootd_summary_schema)
+    rmw = history = metrics.MetricHistory(schema, horizon=horizon)
     if endpoint is not None:
         rmw = metrics.RemoteMetricsWriter(endpoint=endpoint,
-                                          schema=xrootd_summary_schema,
+                                          schema=schema,
                                           job='xrootd',
                                           expiry=10*60)
     elif fake_data:
@@ -481,7 +481,8 @@ if __name__ == '__main__':
     ## which doesn't seem to be possible with remote-write.
     partial_handler = functools.partial(metrics.MetricsHTTPHandler,
                                         hist=history)
-    webserver = HTTPServer((http_host, http_port), partial_handler)
+    webserver = ThreadingHTTPServer((http_host, http_port),
+                                    partial_handler)
     logging.info('Created HTTP server on http://%s:%d' %
                  (http_host, http_port))
 
@@ -503,7 +504,7 @@ if __name__ == '__main__':
 
         ## Use a separate thread to run the server, which we can stop
         ## by calling shutdown().
-        srv_thrd = threading.Thread(target=HTTPServer.serve_forever,
+        srv_thrd = threading.Thread(target=ThreadingHTTPServer.serve_forever,
                                     args=(webserver,))
         srv_thrd.start()
 